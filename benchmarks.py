@@ -0,0 +1,341 @@
+import sys
+import time
+import timeit
+import argparse
+import statistics
+import os
+import tempfile
+import tracemalloc
+import io
+import png
+import snapshot
+import graph_cache
+from get_stock_data import Stock, Universe, read_stock_data, write_stock_data, read_stock_stream, write_stock_stream, render_graphs
+
+# Micro benchmarks for the Stock data layer.
+#   python benchmarks.py --stock_data stock_data.txt
+
+def load_stocks(filename: str) -> {}:
+  stocks = {}
+  f = open(filename, "r", encoding='utf-8')
+  for stock_data in f.read().split("stock data:\n"):
+    if stock_data:
+      stock = Stock('New').load_from_str(stock_data)
+      stocks[stock.get_id()] = stock
+  f.close()
+  return stocks
+
+def legacy_get_data(data: {}, key: str, nitems: int):
+  # get_data as it was on the flat "key = value" string dict
+  keys = sorted(filter(lambda x:key in x, data.keys()), reverse=True)
+
+  rv = []
+  for key in keys:
+    rv.append(float(data[key]))
+    if len(rv) == nitems: break
+
+  return rv
+
+get_data_keys = [
+  ("Q " + Stock.eps_key, 4),
+  ("Q " + Stock.cash_flow_from_operations_key, 4),
+  ("Q " + Stock.operational_profit_key, 4),
+  ("Q " + Stock.sales_key, 4),
+  ("Q " + Stock.net_profit_key, 4),
+  ("A " + Stock.eps_key, 1),
+]
+
+def bench_get_data(stocks: {}, number: int):
+  flat = [s.get_fields() for s in stocks.values()]
+  objs = list(stocks.values())
+
+  for data, stock in zip(flat, objs):
+    for (key, nitems) in get_data_keys:
+      if legacy_get_data(data, key, nitems) != stock.get_data(key, nitems):
+        print("mismatch: %d %s" % (stock.get_id(), key))
+        sys.exit(1)
+
+  def run_legacy():
+    for data in flat:
+      for (key, nitems) in get_data_keys:
+        legacy_get_data(data, key, nitems)
+
+  def run_index():
+    for stock in objs:
+      for (key, nitems) in get_data_keys:
+        stock.get_data(key, nitems)
+
+  legacy = min(timeit.repeat(run_legacy, number=number, repeat=3)) / number
+  index  = min(timeit.repeat(run_index, number=number, repeat=3)) / number
+  print("get_data     %d stocks x %d keys" % (len(objs), len(get_data_keys)))
+  print("  key scan : %8.2f ms" % (1000*legacy))
+  print("  index    : %8.2f ms" % (1000*index))
+  print("  speedup  : %8.1fx" % (legacy / index))
+
+def stock_list_pass(stocks: {}):
+  # the metric reads write_sphinx does: sort by score, then one row per stock
+  for stock in sorted(stocks.values(), key=Stock.sort, reverse=1):
+    stock.get_price_to_earnings_ratio()
+    stock.get_cash_flow_multiplier()
+    stock.get_operational_profit_to_sales_ratio()
+    stock.get_net_profit_to_sales_ratio()
+    stock.get_dividend_average()
+    stock.get_dividend_stdev()
+    stock.get_12month_return()
+    stock.get_earnings_polyfit()
+    stock.get_operational_profit_polyfit()
+
+def bench_metric_cache(stocks: {}):
+  Stock.metric_cache_stats['hits'] = Stock.metric_cache_stats['misses'] = 0
+
+  start = time.perf_counter()
+  stock_list_pass(stocks)
+  cold = time.perf_counter() - start
+
+  start = time.perf_counter()
+  stock_list_pass(stocks)
+  warm = time.perf_counter() - start
+
+  for stock in stocks.values():
+    stock.set_price(stock.get_price())
+
+  start = time.perf_counter()
+  stock_list_pass(stocks)
+  repriced = time.perf_counter() - start
+
+  stats = Stock.get_metric_cache_stats()
+  print("stock list   %d stocks" % len(stocks))
+  print("  cold     : %8.2f ms" % (1000*cold))
+  print("  warm     : %8.2f ms" % (1000*warm))
+  print("  repriced : %8.2f ms" % (1000*repriced))
+  print("  cache    : %d hits, %d misses, %.0f%% hit rate" % (stats['hits'], stats['misses'], 100*stats['hit_rate']))
+
+def check_universe(stocks: {}):
+  universe = Universe(stocks)
+  for i, stock in enumerate(universe.stocks):
+    expected = [
+      stock.get_price_to_earnings_ratio(),
+      stock.get_cash_flow_multiplier(),
+      stock.get_operational_profit_to_sales_ratio(),
+      stock.get_net_profit_to_sales_ratio(),
+      stock.get_dividend_average(),
+      stock.get_dividend_stdev(),
+      statistics.mean(stock.get_five_year_return()),
+      stock.get_12month_return(),
+      stock.get_score(),
+    ]
+    actual = [
+      universe.pe[i],
+      universe.cfm[i],
+      universe.op2s[i],
+      universe.np2s[i],
+      universe.dividend_average[i],
+      universe.dividend_stdev[i],
+      universe.average_return[i],
+      universe.return_12month[i],
+      universe.score[i],
+    ]
+    if expected != actual or stock._fail != universe.get_fail(i):
+      print("universe mismatch: %d %s %s" % (stock.get_id(), expected, actual))
+      sys.exit(1)
+
+def scale_universe(stocks: {}, size: int) -> {}:
+  # copies of the loaded stocks under new ids, standing in for more exchanges
+  scaled = {}
+  data = [stock.as_str() for stock in stocks.values()]
+  for i in range(size):
+    stock = Stock('New').load_from_str(data[i % len(data)])
+    stock._info['id'] = 10000000 + i
+    scaled[stock.get_id()] = stock
+  return scaled
+
+def bench_universe(stocks: {}, size: int):
+  check_universe(stocks)
+  stocks = scale_universe(stocks, size)
+
+  start = time.perf_counter()
+  for stock in stocks.values():
+    stock.get_score()
+  per_stock = time.perf_counter() - start
+
+  start = time.perf_counter()
+  Universe(stocks)
+  universe = time.perf_counter() - start
+
+  print("screen       %d stocks" % len(stocks))
+  print("  get_score: %8.2f ms" % (1000*per_stock))
+  print("  universe : %8.2f ms" % (1000*universe))
+  print("  speedup  : %8.1fx" % (per_stock / universe))
+
+def bench_stock_data_formats(stocks: {}, size: int):
+  stocks = scale_universe(stocks, size)
+  directory = tempfile.mkdtemp()
+  text = os.path.join(directory, "stock_data.txt")
+  binary = os.path.join(directory, "stock_data" + snapshot.extension)
+  write_stock_data(stocks, text)
+  write_stock_data(stocks, binary)
+
+  some = sorted(stocks.keys())[::1000]
+  del stocks
+
+  print("read         %d stocks" % (size))
+  for (name, filename, touch) in (("text", text, None), ("snap open", binary, []), ("snap some", binary, some), ("snap all", binary, None)):
+    start = time.perf_counter()
+    loaded = read_stock_data(filename)
+    for stock_id in (loaded.keys() if touch is None else touch):
+      loaded[stock_id].get_price()
+    elapsed = time.perf_counter() - start
+    print("  %-9s: %8.2f ms, %6.1f MB" % (name, 1000*elapsed, os.path.getsize(filename) / 1e6))
+    del loaded
+
+  os.remove(text)
+  os.remove(binary)
+  os.rmdir(directory)
+
+def rescore_stream(source: str, destination: str):
+  # load -> rescore -> write, one stock at a time
+  fin = open(source, "r", encoding='utf-8')
+  fout = open(destination, "w", encoding='utf-8')
+  def rescored(stocks):
+    for stock in stocks:
+      stock.get_score()
+      yield stock
+  write_stock_stream(fout, rescored(read_stock_stream(fin, source)))
+  fout.close()
+  fin.close()
+
+def rescore_all(source: str, destination: str):
+  stocks = read_stock_data(source)
+  for stock in stocks.values():
+    stock.get_score()
+  write_stock_data(stocks, destination)
+
+def bench_stream(stocks: {}, size: int):
+  stocks = scale_universe(stocks, size)
+  directory = tempfile.mkdtemp()
+  source = os.path.join(directory, "stock_data.txt")
+  destination = os.path.join(directory, "rescored.txt")
+  write_stock_data(stocks, source)
+  del stocks
+
+  print("rescore      %s" % source)
+  for (name, rescore) in (("read all", rescore_all), ("stream", rescore_stream)):
+    tracemalloc.start()
+    start = time.perf_counter()
+    rescore(source, destination)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("  %-9s: %8.2f ms, %8.1f MB peak" % (name, 1000*elapsed, peak / 1e6))
+
+  os.remove(source)
+  os.remove(destination)
+  os.rmdir(directory)
+
+def legacy_bar_graph(data: [], f):
+  # generate_bar_graph as it was, one python list per row, pixel by pixel
+  nbars = len(data)
+
+  if min(data) < 0:
+    data_range = max(data) - min(data)
+    data_min = min(data)
+  else:
+    data_range = max(data)
+    data_min = 0
+
+  width = 1 + nbars * (1 + 3)
+  height = 20
+
+  a = [[255,255,255]*(width*3) for item in range(height)]
+
+  if data_range:
+    for bar in range(0, nbars):
+      bar_x = 4 * bar
+
+      ystart = (data[bar]-data_min)/data_range
+      yzero  = (0        -data_min)/data_range
+      if ystart < 0:
+        (ystart, yend) = (yzero, ystart)
+      else:
+        yend = yzero
+
+      ystart = int(height*(1-ystart))
+      yend   = int(height*(1-yend))
+
+      for y in range(ystart, yend):
+        for x in range(0,9):
+          xi = 3 * bar_x + x
+          a[y][3*xi + 0] = 0
+          a[y][3*xi + 1] = 0
+          a[y][3*xi + 2] = 0
+
+  w = png.Writer(width*3, height, greyscale=False)
+  w.write(f, a)
+
+def bar_graph(data: [], f):
+  # the png of write_sphinx, into a file object
+  f.write(Stock.bar_graph_png(Stock.bar_graph_pixels(data)))
+
+def bench_bar_graphs(stocks: {}):
+  # the four graphs of every stock, as generate_figures draws them
+  graphs = []
+  for stock in stocks.values():
+    graphs += [stock.get_four_year_data(Stock.dividend_key), stock.get_five_year_return(),
+               stock.get_four_year_data(Stock.earnings_key), stock.get_four_year_data(Stock.operational_profit_key)]
+
+  def render(draw):
+    files = []
+    start = time.perf_counter()
+    for data in graphs:
+      f = io.BytesIO()
+      draw(data, f)
+      files.append(f.getvalue())
+    return (time.perf_counter() - start, files)
+
+  (legacy, legacy_files) = render(legacy_bar_graph)
+  (raster, raster_files) = render(bar_graph)
+  for data, legacy_file, raster_file in zip(graphs, legacy_files, raster_files):
+    if legacy_file != raster_file:
+      print("bar graph mismatch: %s" % (data,))
+      sys.exit(1)
+
+  print("bar graphs   %d graphs" % len(graphs))
+  print("  lists    : %8.2f ms" % (1000*legacy))
+  print("  numpy    : %8.2f ms" % (1000*raster))
+  print("  speedup  : %8.1fx" % (legacy / raster))
+
+def bench_render_graphs(stocks: {}, size: int, jobs: int):
+  # every graph of the universe drawn, each copy with its own dividends so
+  # that no two dividend series are the same
+  stocks = scale_universe(stocks, size)
+  for i, stock in enumerate(stocks.values()):
+    stock.set_annual_data(Stock.dividend_key, 2018, 1000 + i)
+
+  print("render       %d graphs" % (4 * len(stocks)))
+  for njobs in sorted(set((1, jobs))):
+    directory = tempfile.mkdtemp()
+    cache = graph_cache.GraphCache(os.path.join(directory, "graph_cache.json"), directory)
+    start = time.perf_counter()
+    render_graphs(list(stocks.values()), cache, njobs)
+    elapsed = time.perf_counter() - start
+    print("  %2d jobs  : %8.2f ms, %d series, %d files" % (njobs, 1000*elapsed, len(cache.files), cache.drawn))
+    for name in os.listdir(directory):
+      os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Stock benchmarks')
+  parser.add_argument("--stock_data", default="stock_data.txt", type=str, help="Stock data file to benchmark on.")
+  parser.add_argument("--number", default=20, type=int, help="Iterations per measurement.")
+  parser.add_argument("--universe_size", default=20000, type=int, help="Number of stocks in the screening benchmark.")
+  parser.add_argument("--jobs", default=os.cpu_count(), type=int, help="Processes of the graph rendering benchmark.")
+  args = parser.parse_args()
+
+  stocks = load_stocks(args.stock_data)
+  bench_get_data(stocks, args.number)
+  bench_metric_cache(stocks)
+  bench_universe(stocks, args.universe_size)
+  bench_stock_data_formats(stocks, args.universe_size)
+  bench_stream(stocks, args.universe_size // 10)
+  bench_bar_graphs(stocks)
+  bench_render_graphs(stocks, args.universe_size, args.jobs)
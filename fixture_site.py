@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import urllib.parse
+import argparse
+import multiprocessing
+
+# Local stand-in for the bizportal quote pages, to run the http fetcher and
+# the page parsing without the site.
+#
+# The pages under fixtures/site are recordings of the site: record fetches
+# the pages of some stocks with http_fetch, the url the annual tab of the
+# reports page loads included, and keeps every response as it came, under its
+# path. The server answers every recorded page after a fixed latency, like a
+# remote site. The stock data checked against should be scraped with the
+# browser the day the pages are recorded.
+#
+#   python fixture_site.py record                  records the pages of the first stocks of stock_data.txt
+#   python fixture_site.py serve                   serves them on http://127.0.0.1:8765 (--port)
+#   python fixture_site.py check                   scrapes them with --fetcher http and
+#                                                  compares with the stock data
+
+directory = "fixtures/site"
+quote = "capitalmarket/quote"
+
+def page_file(url: str) -> str:
+  # the file of a recorded page, by its path and query
+  parts = urllib.parse.urlsplit(url)
+  path = parts.path + ("?" + parts.query if parts.query else "")
+  return os.path.join(directory, urllib.parse.quote(path.lstrip("/"), safe="/"))
+
+def record(stocks, base: str, count: int = 60) -> []:
+  # records the pages of the first count stocks that are not skipped, through
+  # a page cache that is thrown away; returns the stocks whose pages were all
+  # fetched
+  import http_fetch
+  import page_cache
+
+  stock_ids = [stock_id for stock_id in sorted(stocks.keys()) if not stocks[stock_id].skip()][:count]
+  cache_file = os.path.join(tempfile.mkdtemp(), "pages.cache")
+  cache = page_cache.PageCache(cache_file)
+  recorded = []
+
+  def handle(stock_id, documents, error):
+    if error is not None or 'reports annual' not in documents:
+      print("%d: not recorded: %s" % (stock_id, error if error is not None else "no annual reports"))
+      return False
+    recorded.append(stock_id)
+    return True
+
+  http_fetch.fetch_all(stock_ids, handle, base, cache=cache)
+  for (url, state, _, _) in cache.get_pages():
+    if state != "":
+      continue
+    path = page_file(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path, "w", encoding='utf-8')
+    f.write(cache.get(url, state, False))
+    f.close()
+  cache.close()
+  os.remove(cache_file)
+  os.rmdir(os.path.dirname(cache_file))
+  return sorted(recorded)
+
+def get_stock_ids() -> []:
+  # the recorded stocks
+  path = os.path.join(directory, quote, "reports")
+  if not os.path.isdir(path):
+    return []
+  return sorted(int(name) for name in os.listdir(path))
+
+def serve(port: int = 8765, latency: float = 0.05):
+  from aiohttp import web
+
+  async def page(request):
+    await asyncio.sleep(latency)
+    path = page_file(request.path_qs)
+    if not os.path.isfile(path):
+      raise web.HTTPNotFound()
+    f = open(path, "r", encoding='utf-8')
+    text = f.read()
+    f.close()
+    return web.Response(text=text, content_type="text/html")
+
+  app = web.Application()
+  app.router.add_get("/{tail:.*}", page)
+  web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+# the fields the pages carry
+checked_labels = ('A EPS', 'A earnings', 'A operational_profit', 'A dividend', 'A return',
+                  'Q sales', 'Q operational_profit', 'Q net_profit', 'Q EPS', 'Q cash_flow_from_operations')
+
+def check(reference, port: int = 8765, connections: int = 8) -> int:
+  # scrapes the served pages into empty stocks and returns the number of
+  # values that differ from the reference stock data
+  import get_stock_data
+
+  stock_ids = get_stock_ids()
+  if not stock_ids:
+    print("no recorded pages in %s, run record first" % directory)
+    return 1
+  stocks = dict((stock_id, get_stock_data.Stock(stock_id).load_fields({'id': str(stock_id), 'name': reference[stock_id].get_name()})) for stock_id in stock_ids)
+  # the scraped stocks are journaled next to a stock data file that is
+  # never written
+  journal = os.path.join(tempfile.mkdtemp(), "stock_data.txt")
+  get_stock_data.args = get_stock_data.make_parser().parse_args([
+    "--fetcher", "http", "--base_url", "http://127.0.0.1:%d" % port, "--http_connections", str(connections),
+    "--rate_limit", "1000", "--max_in_flight", "64", "--write_stock_data", journal])
+
+  start = time.perf_counter()
+  get_stock_data.scrub_http(stocks, stock_ids)
+  print("scraped %d stocks in %.2fs" % (len(stock_ids), time.perf_counter() - start))
+  get_stock_data.StockJournal.remove(journal)
+  os.rmdir(os.path.dirname(journal))
+
+  differences = 0
+  for stock_id in stock_ids:
+    fields = stocks[stock_id].get_fields()
+    for key, value in reference[stock_id].get_fields().items():
+      if not (key in ('price', 'market_capital') or any(key.startswith(label + " ") for label in checked_labels)):
+        continue
+      if key not in fields or float(fields[key]) != float(value):
+        print("%d %s: %s scraped as %s" % (stock_id, key, value, fields.get(key)))
+        differences += 1
+  return differences
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Local stand-in for the bizportal quote pages')
+  parser.add_argument("command", choices=("record", "serve", "check"))
+  parser.add_argument("--stock_data", default="stock_data.txt", type=str, help="Stock data the recorded stocks are taken from and checked against.")
+  parser.add_argument("--count", default=60, type=int, help="Number of stocks record fetches the pages of.")
+  parser.add_argument("--base_url", default="https://www.bizportal.co.il", type=str, help="Site record fetches the pages from.")
+  parser.add_argument("--port", default=8765, type=int, help="Port the pages are served on.")
+  fixture_args = parser.parse_args()
+
+  if fixture_args.command == "serve":
+    serve(fixture_args.port)
+    sys.exit(0)
+
+  from get_stock_data import read_stock_data
+  stocks = read_stock_data(fixture_args.stock_data)
+
+  if fixture_args.command == "record":
+    print("recorded the pages of %d stocks in %s" % (len(record(stocks, fixture_args.base_url, fixture_args.count)), directory))
+  else:
+    server = multiprocessing.Process(target=serve, args=(fixture_args.port,))
+    server.start()
+    time.sleep(1)
+    try:
+      differences = check(stocks, fixture_args.port)
+    finally:
+      server.terminate()
+    print("%d values differ" % differences)
+    sys.exit(1 if differences else 0)
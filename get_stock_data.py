@@ -1,41 +1,226 @@
 import numpy
+import os
 import sys
 import codecs
 import re
 import statistics
 import locale
 import time
+import datetime
+import hashlib
 import argparse
+import functools
+import collections.abc
+import multiprocessing
+import queue
+import traceback
 import png
+import snapshot
+import stock_db
+import history
+import page_cache
+import graph_cache
+import rate_limit
+import json
+import io
+import csv
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+
+class StockDataError(ValueError):
+
+  def __init__(self, line_number: int, line: str, filename: str = None) -> None:
+    self.line_number = line_number
+    self.line = line
+    self.filename = filename
+    super().__init__("%s:%d: cannot parse stock data line '%s'" % (filename or "<stock data>", line_number, line))
+
+class Series():
+  # Values of one metric kept as parallel numpy arrays sorted by period.
+  # A period is the year for annual data and year*10+quarter for quarter data.
+
+  def __init__(self, periods = [], values = []) -> None:
+    order = numpy.argsort(numpy.asarray(periods, dtype=numpy.int64), kind='stable')
+    self.periods = numpy.asarray(periods, dtype=numpy.int64)[order]
+    self.values  = numpy.asarray(values, dtype=numpy.float64)[order]
+
+  @staticmethod
+  def from_sorted(periods, values):
+    # periods already sorted, e.g. arrays read from a snapshot
+    series = Series.__new__(Series)
+    (series.periods, series.values) = (periods, values)
+    return series
+
+  def __len__(self) -> int:
+    return len(self.periods)
+
+  def set(self, period: int, value: float):
+    i = numpy.searchsorted(self.periods, period)
+    if i < len(self.periods) and self.periods[i] == period:
+      self.values[i] = value
+    else:
+      self.periods = numpy.insert(self.periods, i, period)
+      self.values  = numpy.insert(self.values, i, value)
+
+  def get(self, period: int, default = 0):
+    i = numpy.searchsorted(self.periods, period)
+    if i < len(self.periods) and self.periods[i] == period:
+      return float(self.values[i])
+    return default
+
+  def latest(self, nitems: int = 0) -> []:
+    # newest first, all items if nitems is 0
+    values = self.values[::-1]
+    if nitems: values = values[:nitems]
+    return values.tolist()
+
+  def items(self):
+    return zip(self.periods.tolist(), self.values.tolist())
+
+def cached_metric(metric: str):
+  # Memoizes a Stock metric until one of the fields it is calculated from
+  # (Stock.metric_fields[metric]) is changed.
+  def decorator(calculate):
+    @functools.wraps(calculate)
+    def get(self):
+      if metric in self._cache:
+        Stock.metric_cache_stats['hits'] += 1
+        return self._cache[metric]
+      Stock.metric_cache_stats['misses'] += 1
+      value = calculate(self)
+      self._cache[metric] = value
+      return value
+    return get
+  return decorator
 
 class Stock():
 
+  scalar_keys = ('price', 'number_of_shares', 'market_capital')
+
   def __init__(self,
                id: int) -> None:
-    self._data = {}
-    self._data['id'] = id
+    self._info = {}       # id, name, +skip and any other raw string fields
+    self._scalars = {}    # price, number_of_shares, market_capital as floats
+    self._series = {}     # "A <metric>" / "Q <metric>" -> Series
+    self._cache = {}      # metric -> memoized value, see cached_metric
+    self._info['id'] = id
+
+  @staticmethod
+  def annual_label(name: str) -> str:
+    return "A " + name
+
+  @staticmethod
+  def quarter_label(name: str) -> str:
+    return "Q " + name
+
+  @staticmethod
+  def quarter_period(year: int, quarter: int) -> int:
+    return year * 10 + quarter
+
+  def get_fields(self) -> {}:
+    # flat key -> string view of the stock, in the stock data file layout
+    fields = dict(self._info)
+    for key, value in self._scalars.items():
+      fields[key] = str(value)
+    for label, series in self._series.items():
+      quarterly = label.startswith("Q ")
+      for (period, value) in series.items():
+        if quarterly:
+          key = "%s %d %d" % (label, period // 10, period % 10)
+        else:
+          key = "%s %d" % (label, period)
+        fields[key] = str(value)
+    return fields
 
   def as_str(self):
     rv = ""
-    for key in sorted(self._data.keys()):
-      rv += "  %s = %s\n" % (key, self._data[key])
+    fields = self.get_fields()
+    for key in sorted(fields.keys()):
+      rv += "  %s = %s\n" % (key, fields[key])
 
     return rv
 
   def load_from_str(self, data_str: str):
-    for line in data_str.split('\n'):
-      if line:
-        line = line.strip()
-        # print(">%s<" % line[0:6])
+    return self.load_from_lines(enumerate(data_str.split('\n'), 1))
+
+  def load_from_lines(self, lines):
+    # lines are (line number, line) pairs, the numbers are used in errors
+    series = {}
+    for (line_number, line) in lines:
+      line = line.strip()
+      if not line: continue
+      try:
         (key,value) = line.split(" = ")
-        self._data[key] = value
+        self.load_field(key, value, series)
+      except ValueError:
+        raise StockDataError(line_number, line)
+
+    return self.load_series(series)
+
+  def load_fields(self, fields: {}):
+    # inverse of get_fields
+    series = {}
+    for key, value in fields.items():
+      self.load_field(key, value, series)
+    return self.load_series(series)
+
+  def load_series(self, series: {}):
+    for label, data in series.items():
+      self._series[label] = Series(list(data.keys()), list(data.values()))
+    self._cache = {}
+    return self
+
+  def load_field(self, key: str, value: str, series: {}):
+    # series collects label -> {period: value} so arrays are built once per metric
+    parts = key.split(" ")
+    if parts[0] == "A" and len(parts) == 3:
+      series.setdefault(Stock.annual_label(parts[1]), {})[int(parts[2])] = float(value)
+    elif parts[0] == "Q" and len(parts) == 4:
+      period = Stock.quarter_period(int(parts[2]), int(parts[3]))
+      series.setdefault(Stock.quarter_label(parts[1]), {})[period] = float(value)
+    elif key in Stock.scalar_keys:
+      self._scalars[key] = float(value)
+    else:
+      self._info[key] = value
+
+  def get_record(self):
+    # plain data of the stock, see snapshot.py
+    info = dict((key, str(value)) for key, value in self._info.items())
+    series = dict((label, (s.periods, s.values)) for label, s in self._series.items())
+    return (info, dict(self._scalars), series)
+
+  def load_record(self, record):
+    (info, scalars, series) = record
+    self._info = dict(info)
+    self._scalars = dict(scalars)
+    self._series = {}
+    for label, (periods, values) in series.items():
+      self._series[label] = Series.from_sorted(periods, values)
+    self._cache = {}
+    return self
+
+  def update(self, stock):
+    # sets the values of stock that differ from this stock's through the
+    # setters, values stock does not have are kept; scalars stock lacks are
+    # removed, as set_price_and_market_capital removes market_capital
+    for key, value in stock._info.items():
+      if self._info.get(key) != value:
+        self.set_info(key, value)
+    for key in Stock.scalar_keys:
+      if stock._scalars.get(key) != self._scalars.get(key):
+        self.set_scalar(key, stock._scalars.get(key))
+    for label, series in stock._series.items():
+      current = self._series.get(label)
+      for (period, value) in series.items():
+        if current is None or current.get(period, None) != value:
+          self.set_series_data(label, period, value)
     return self
 
   def skip(self) -> bool:
-    if '+skip' in self._data.keys():
-      return self._data['+skip']
+    if '+skip' in self._info.keys():
+      return self._info['+skip']
     else:
       return False
 
@@ -63,7 +248,13 @@ class Stock():
     rv += "     - Op. profit graph\n"
     return rv
 
-  def get_stock_list_row(self) -> str:
+  @staticmethod
+  def get_graph_cell(markup: str) -> str:
+    # a list-table cell holding the markup, indented under its "-"
+    return "     -\n\n" + "".join(("       " + line if line else "") + "\n" for line in markup.split("\n")) + "\n"
+
+  def get_stock_list_row(self, graphs: {}) -> str:
+    # graphs is graph name -> the rst markup showing it
     rv = ""
     rv += "  *  - `%s <%s%d>`_\n" % (self.get_name(), "https://www.bizportal.co.il/capitalmarket/quote/reports/", self.get_id())
   
@@ -111,72 +302,77 @@ class Stock():
     else:
       rv += "S:%.1f\n\n" % dstd
 
-    rv += "     -\n\n"
-    rv += "       .. image:: _static/png/dividend_%d.png\n\n" % self.get_id()
+    rv += Stock.get_graph_cell(graphs['dividend'])
 
     rv += "     - 12m:%.1f\n" % self.get_12month_return()
 
-    rv += "     -\n\n"
-    rv += "       .. image:: _static/png/return_%d.png\n\n" % self.get_id()
+    rv += Stock.get_graph_cell(graphs['return'])
 
-    earnings_polyfit = self.polyfit(self.get_four_year_data(Stock.earnings_key))
+    earnings_polyfit = self.get_earnings_polyfit()
     rv += "     - %.2f,%d%%\n" % (earnings_polyfit[0], 100*earnings_polyfit[1])
 
-    rv += "     -\n\n"
-    rv += "       .. image:: _static/png/earnings_%d.png\n\n" % self.get_id()
+    rv += Stock.get_graph_cell(graphs['earnings'])
 
-    op_polyfit = self.polyfit(self.get_four_year_data(Stock.operational_profit_key))
+    op_polyfit = self.get_operational_profit_polyfit()
     rv += "     - %.2f,%.0f%%\n" % (op_polyfit[0], 100*op_polyfit[1])
 
-    rv += "     -\n\n"
-    rv += "       .. image:: _static/png/operational_profit_%d.png\n\n" % self.get_id()
-
-    self.generate_figures()
+    rv += Stock.get_graph_cell(graphs['operational_profit'])
 
     return rv
 
   # raw data
 
   def get_id(self) -> int:
-    return int(self._data['id'])
+    return int(self._info['id'])
 
-  def set_name(self, name: str):
-    self._data['name'] = name
+  def set_info(self, key: str, value: str):
+    self._info[key] = value
     return self
 
+  def get_info(self, key: str, default = None):
+    return self._info.get(key, default)
+
+  def set_name(self, name: str):
+    return self.set_info('name', name)
+
   def get_name(self) -> str:
-    return self._data['name']
+    return self._info['name']
 
   def set_price(self, price: float):
-    self._data['price'] = str(price)
+    self._scalars['price'] = float(price)
+    self.invalidate('price')
     return self
 
   def get_price(self) -> float:
-    try:
-      return float(self._data['price'])
-    except:
-      return 0
+    return self._scalars.get('price', 0)
+
+  def set_scalar(self, key: str, value: float):
+    # None removes the scalar
+    if value is None:
+      self._scalars.pop(key, None)
+    else:
+      self._scalars[key] = float(value)
+    self.invalidate(key)
+    return self
 
   def set_price_and_market_capital(self, price: float, market_capital: float):
-    self._data['price'] = str(price)
-    # self._data['market_capital'] = str(market_capital)
-    self._data['number_of_shares'] = str( market_capital / price )
-    if 'market_capital' in self._data.keys():
-      del self._data['market_capital']
+    self._scalars['price'] = float(price)
+    # self._scalars['market_capital'] = float(market_capital)
+    self._scalars['number_of_shares'] = float( market_capital / price )
+    if 'market_capital' in self._scalars.keys():
+      del self._scalars['market_capital']
+    self.invalidate('price', 'number_of_shares', 'market_capital')
     return self
 
   def get_market_capital(self) -> float:
-    if not 'number_of_shares' in self._data.keys():
-      try:
-        return float(self._data['market_capital'])
-      except:
-        return 0
+    if not 'number_of_shares' in self._scalars.keys():
+      return self._scalars.get('market_capital', 0)
 
-    try:
-      return float(self._data['price']) * float(self._data['number_of_shares'])
-    except:
+    if not 'price' in self._scalars.keys():
       return 0
 
+    return self._scalars['price'] * self._scalars['number_of_shares']
+
   eps_key                       = "EPS"
   cash_flow_from_operations_key = "cash_flow_from_operations"
   dividend_key                  = "dividend"
@@ -186,25 +382,73 @@ class Stock():
   sales_key                     = "sales"
   net_profit_key                = "net_profit"
 
+  # metric -> fields (scalar keys and series labels) it is calculated from
+  metric_fields = {
+    'latest_eps'                 : ("Q " + eps_key, "A " + eps_key),
+    'pe'                         : ('price', "Q " + eps_key, "A " + eps_key),
+    'cfm'                        : scalar_keys + ("Q " + cash_flow_from_operations_key,),
+    'op2s'                       : ("Q " + operational_profit_key, "Q " + sales_key),
+    'np2s'                       : ("Q " + sales_key, "Q " + net_profit_key),
+    'dividend_average'           : ("A " + dividend_key,),
+    'dividend_stdev'             : ("A " + dividend_key,),
+    'five_year_return'           : ("A " + return_key,),
+    '12month_return'             : ("A " + return_key,),
+    'earnings_polyfit'           : ("A " + earnings_key,),
+    'operational_profit_polyfit' : ("A " + operational_profit_key,),
+  }
+  metric_fields['score'] = scalar_keys + ("Q " + eps_key, "A " + eps_key,
+    "Q " + cash_flow_from_operations_key, "Q " + operational_profit_key, "Q " + sales_key,
+    "Q " + net_profit_key, "A " + dividend_key, "A " + return_key)
+
+  # filled in below the class: field -> metrics calculated from it
+  field_metrics = {}
+
+  metric_cache_stats = {'hits': 0, 'misses': 0}
+
+  @staticmethod
+  def get_metric_cache_stats() -> {}:
+    hits = Stock.metric_cache_stats['hits']
+    misses = Stock.metric_cache_stats['misses']
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0}
+
+  def invalidate(self, *fields):
+    for field in fields:
+      for metric in Stock.field_metrics.get(field, ()):
+        self._cache.pop(metric, None)
+
+  def set_series_data(self, label: str, period: int, data: float):
+    if label in self._series:
+      self._series[label].set(period, float(data))
+    else:
+      self._series[label] = Series([period], [float(data)])
+    self.invalidate(label)
+
   def set_annual_data(self, name: str, year: int, data: float):
-    self._data["A %s %d" % (name, year)] = str(data)
+    self.set_series_data(Stock.annual_label(name), year, data)
     return self
 
   def get_data(self, key: str, nitems: int):
-    keys = sorted(filter(lambda x:key in x, self._data.keys()), reverse=True)
+    # key is an exact series label ("A <metric>" or "Q <metric>"), latest first
+    series = self._series.get(key)
+    if series is None:
+      return []
 
-    rv = []
-    for key in keys:
-      rv.append(float(self._data[key]))
-      if len(rv) == nitems: break
-
-    return rv
+    return series.latest(nitems)
 
   def get_annual_data(self, key: str, nitems: int = 0):
     return self.get_data("A " + key, nitems)
 
+  def get_series(self, label: str, default = None) -> Series:
+    return self._series.get(label, default)
+
+  def get_year_data(self, key: str, year: int, default = 0):
+    series = self._series.get(Stock.annual_label(key))
+    if series is None:
+      return default
+    return series.get(year, default)
+
   def set_quarter_data(self, name: str, year: int, quarter: int, cash_from_from_operations: float):
-    self._data["Q %s %d %d" % (name, year, quarter)] = str(cash_from_from_operations)
+    self.set_series_data(Stock.quarter_label(name), Stock.quarter_period(year, quarter), cash_from_from_operations)
 
   def get_quarter_data(self, key: str, nitems: int = 0):
     return self. get_data("Q " + key, nitems)
@@ -228,6 +472,12 @@ class Stock():
 
 
   def get_score(self):
+    (score, self._fail) = self.get_screen()
+    return score
+
+  @cached_metric('score')
+  def get_screen(self):
+    # (score, list of failed criteria)
     pe = self.get_price_to_earnings_ratio()
     cfm = self.get_cash_flow_multiplier()
     op2s = self.get_operational_profit_to_sales_ratio()
@@ -250,19 +500,18 @@ class Stock():
     if davg > 0.5 * ravg:              fail.append(Stock.fail_avg_dvdnd_large)
     if rlast < 10:                     fail.append(Stock.fail_12month_return_small)
 
-    self._fail = fail
-
     if self.get_id() == 1082379:
       print("%s" % fail)
 
     if len(fail) > 0:
       score = numpy.prod([i[0] for i in fail])
-      return score
+      return (score, fail)
     
-    return 15-pe
+    return (15-pe, fail)
 
   #steady rise in annual earnings + operational profit
 
+  @cached_metric('latest_eps')
   def get_latest_eps(self):
     # Look at last four quarters if possible
     eps = sum(self.get_quarter_data(Stock.eps_key, 4))
@@ -274,6 +523,7 @@ class Stock():
     except:
       return 0
 
+  @cached_metric('pe')
   def get_price_to_earnings_ratio(self) -> float:
     latest_eps = self.get_latest_eps()
     if latest_eps:
@@ -281,6 +531,7 @@ class Stock():
     else:
       return 0
 
+  @cached_metric('cfm')
   def get_cash_flow_multiplier(self):
     # look at the cash flow from current activity of the last four quarters
     # and not the last year
@@ -293,6 +544,7 @@ class Stock():
 
     return self.get_market_capital() / cash_flow_from_operations
 
+  @cached_metric('op2s')
   def get_operational_profit_to_sales_ratio(self):
     # look at the cash flow from current activity of the last four quarters
     # and not the last year
@@ -308,6 +560,7 @@ class Stock():
 
     return operational_profit / sales
 
+  @cached_metric('np2s')
   def get_net_profit_to_sales_ratio(self):
     # look at the cash flow from current activity of the last four quarters
     # and not the last year
@@ -323,38 +576,41 @@ class Stock():
 
     return net_profit / sales
 
+  @cached_metric('dividend_average')
   def get_dividend_average(self):
     return statistics.mean(self.get_four_year_data(Stock.dividend_key))
 
+  @cached_metric('dividend_stdev')
   def get_dividend_stdev(self):
     return statistics.stdev(self.get_four_year_data(Stock.dividend_key))
   
+  @cached_metric('five_year_return')
   def get_five_year_return(self):
     returns = []
     for year in range(2015,2020):
-      try:
-        returns.append(float(self._data["A %s %d" % (Stock.return_key, year)]))
-      except:
-        returns.append(0)
-      
+      returns.append(self.get_year_data(Stock.return_key, year))
+
     return returns
 
+  @cached_metric('12month_return')
   def get_12month_return(self):
-      try:
-        return float(self._data["A %s %d" % (Stock.return_key, 2019)])
-      except:
-        return 0
+      return self.get_year_data(Stock.return_key, 2019)
 
   def get_four_year_data(self, key: str) -> []:
     data = []
     for year in range(2015,2019):
-      try:
-        data.append(float(self._data["A %s %d" % (key, year)]))
-      except:
-        data.append(0)
+      data.append(self.get_year_data(key, year))
 
     return data
 
+  @cached_metric('earnings_polyfit')
+  def get_earnings_polyfit(self):
+    return self.polyfit(self.get_four_year_data(Stock.earnings_key))
+
+  @cached_metric('operational_profit_polyfit')
+  def get_operational_profit_polyfit(self):
+    return self.polyfit(self.get_four_year_data(Stock.operational_profit_key))
+
   def polyfit(self, data: []):
     (p, residuals, rank, singular_values, rcond) = numpy.polyfit(range(0,len(data)), data, 1, full=True)
     #p[0] is the slope]
@@ -366,7 +622,20 @@ class Stock():
     else:
       return(0,0)
 
-  def generate_bar_graph(self, data: [], filename: str):
+  # bar graphs: 20 pixels high, a bar 9 pixels wide every 12 pixels
+  bar_graph_height = 20
+  bar_graph_pitch = 12
+  bar_graph_bar_width = 9
+  bar_graph_parameters = ('bar', bar_graph_height, bar_graph_pitch, bar_graph_bar_width)
+
+  @staticmethod
+  def bar_graph_width(data: []) -> int:
+    return 3 * (1 + len(data) * (1 + 3))
+
+  @staticmethod
+  def bar_graph_bars(data: []) -> []:
+    # (x, top, bottom) of every bar drawn, from the zero line to the value,
+    # rows top to bottom - 1
     nbars = len(data)
 
     if min(data) < 0:
@@ -376,51 +645,259 @@ class Stock():
       data_range = max(data)
       data_min = 0
 
-    width = 1 + nbars * (1 + 3)
-    height = 20
-
-    a = [[255,255,255]*(width*3) for item in range(height)]
+    height = Stock.bar_graph_height
+    bars = []
 
     if data_range:
       for bar in range(0, nbars):
 
-        bar_x = 4 * bar
-
         ystart = (data[bar]-data_min)/data_range
         yzero  = (0        -data_min)/data_range
-        #print("start, zero %d %d" % (ystart, yzero))
         if ystart < 0:
           (ystart, yend) = (yzero, ystart)
         else:
           yend = yzero
 
-        #print("%f %f %f" % (data[bar], data_min, data_range))
-        #print("%d %d" % (ystart, yend))
-
         ystart = int(height*(1-ystart))
         yend   = int(height*(1-yend))
 
-        for y in range(ystart, yend):
-          for x in range(0,9):
-            xi = 3 * bar_x + x
+        # the zero line of an all negative series is above the graph, its
+        # bars (yend < 0) are not drawn
+        if ystart < yend:
+          bars.append((Stock.bar_graph_pitch * bar, ystart, yend))
 
-            #print("w h x y %s %d %d bar: %d %d %d %d %d" % (data, ystart, yend, bar, width, height, x,y))
+    return bars
 
-            a[y][3*xi + 0] = 0
-            a[y][3*xi + 1] = 0
-            a[y][3*xi + 2] = 0
+  @staticmethod
+  def bar_graph_pixels(data: []):
+    # height x width x RGB uint8 raster, black bars on white
+    pixels = numpy.full((Stock.bar_graph_height, Stock.bar_graph_width(data), 3), 255, dtype=numpy.uint8)
+    for (x, top, bottom) in Stock.bar_graph_bars(data):
+      pixels[top:bottom, x:x + Stock.bar_graph_bar_width] = 0
+    return pixels
 
-    f = open(filename, 'wb')
-    w = png.Writer(width*3, height, greyscale=False)
-    w.write(f, a)
-    f.close()
+  @staticmethod
+  def bar_graph_svg(data: []) -> str:
+    # the same bars as one svg path, to be inlined into the page
+    path = "".join("M%d %dh%dv%dh-%dz" % (x, top, Stock.bar_graph_bar_width, bottom - top, Stock.bar_graph_bar_width)
+                   for (x, top, bottom) in Stock.bar_graph_bars(data))
+    return '<svg width="%d" height="%d" style="background:#fff"><path d="%s"/></svg>' % (
+      Stock.bar_graph_width(data), Stock.bar_graph_height, path)
 
-  def generate_figures(self):
-    # print("%d" % self.get_id())
-    self.generate_bar_graph(self.get_four_year_data(Stock.dividend_key), 'source/_static/png/dividend_%d.png' % self.get_id())
-    self.generate_bar_graph(self.get_five_year_return(), 'source/_static/png/return_%d.png' % self.get_id())
-    self.generate_bar_graph(self.get_four_year_data(Stock.earnings_key), 'source/_static/png/earnings_%d.png' % self.get_id())
-    self.generate_bar_graph(self.get_four_year_data(Stock.operational_profit_key), 'source/_static/png/operational_profit_%d.png' % self.get_id())
+  @staticmethod
+  def bar_graph_png(pixels) -> bytes:
+    (height, width, _) = pixels.shape
+
+    f = io.BytesIO()
+    w = png.Writer(width, height, greyscale=False)
+    w.write(f, pixels.reshape(height, width * 3))
+    return f.getvalue()
+
+  def get_graphs(self) -> {}:
+    # graph name -> the series it draws
+    return {
+      'dividend': self.get_four_year_data(Stock.dividend_key),
+      'return': self.get_five_year_return(),
+      'earnings': self.get_four_year_data(Stock.earnings_key),
+      'operational_profit': self.get_four_year_data(Stock.operational_profit_key),
+    }
+
+for metric, fields in Stock.metric_fields.items():
+  for field in fields:
+    Stock.field_metrics.setdefault(field, []).append(metric)
+
+# Error free transformations used to reproduce the correctly rounded results
+# of statistics.mean / statistics.stdev on whole numpy arrays.
+
+def two_sum(a, b):
+  s = a + b
+  bb = s - a
+  return (s, (a - (s - bb)) + (b - bb))
+
+def two_prod(a, b):
+  p = a * b
+  c = 134217729.0 * a
+  (ah, al) = (c - (c - a), a - (c - (c - a)))
+  c = 134217729.0 * b
+  (bh, bl) = (c - (c - b), b - (c - (c - b)))
+  return (p, ((ah*bh - p) + ah*bl + al*bh) + al*bl)
+
+def dd_div(hi, lo, n: int):
+  # (hi + lo) / n as a double-double
+  q = hi / n
+  (p, pl) = two_prod(q, numpy.full_like(q, n))
+  return two_sum(q, (((hi - p) - pl) + lo) / n)
+
+def dd_row_sum(data):
+  (hi, lo) = (data[:, 0].copy(), numpy.zeros(len(data)))
+  for c in range(1, data.shape[1]):
+    (hi, t) = two_sum(hi, data[:, c])
+    lo += t
+  return two_sum(hi, lo)
+
+def row_mean(data):
+  # statistics.mean of every row
+  (hi, lo) = dd_row_sum(data)
+  return dd_div(hi, lo, data.shape[1])[0]
+
+def row_stdev(data):
+  # statistics.stdev of every row
+  n = data.shape[1]
+  (m, ml) = dd_div(*dd_row_sum(data), n)
+  (hi, lo) = (numpy.zeros(len(data)), numpy.zeros(len(data)))
+  for c in range(n):
+    (d, dl) = two_sum(data[:, c], -m)
+    (d, dl) = two_sum(d, dl - ml)
+    (p, pl) = two_prod(d, d)
+    (hi, t) = two_sum(hi, p)
+    lo += t + pl + 2 * d * dl
+  (v, vl) = dd_div(*two_sum(hi, lo), n - 1)
+  r = numpy.sqrt(v)
+  (p, pl) = two_prod(r, r)
+  correction = numpy.divide(((v - p) - pl) + vl, 2 * r, out=numpy.zeros(len(r)), where=r > 0)
+  return r + correction
+
+def row_sum(data):
+  # sum() of every row, adding the columns left to right like sum() does
+  total = numpy.zeros(len(data))
+  for c in range(data.shape[1]):
+    total = total + data[:, c]
+  return total
+
+class Universe():
+  # Runs the get_score screen on all stocks at once. The inputs of every stock
+  # are gathered into numpy arrays (one entry per stock) and each ratio, the
+  # failed criteria and the score are calculated on the whole arrays. Results
+  # are identical to calling get_score on every stock.
+
+  # in the order get_score checks them
+  criteria = [
+    Stock.fail_high_pe,
+    Stock.fail_cfm_lt_pe,
+    Stock.fail_cfm_negative,
+    Stock.fail_op2s_small,
+    Stock.fail_np2s_small,
+    Stock.fail_avg_dvdnd_small,
+    Stock.fail_avg_return_small,
+    Stock.fail_avg_dvdnd_large,
+    Stock.fail_12month_return_small,
+  ]
+
+  def __init__(self, stocks: {}) -> None:
+    self.stocks = list(stocks.values())
+    self.ids = numpy.array([stock.get_id() for stock in self.stocks], dtype=numpy.int64)
+    self.price = numpy.array([stock.get_price() for stock in self.stocks], dtype=numpy.float64)
+    self.market_capital = numpy.array([stock.get_market_capital() for stock in self.stocks], dtype=numpy.float64)
+    self.screen()
+
+  def gather(self, label: str):
+    # all stocks' series concatenated: (stock index, periods, values), each
+    # stock's values in period order
+    empty = Series()
+    series = [stock.get_series(label, empty) for stock in self.stocks]
+    periods = [s.periods for s in series] + [empty.periods]
+    values = [s.values for s in series] + [empty.values]
+    lengths = numpy.fromiter(map(len, periods[:-1]), dtype=numpy.int64, count=len(series))
+    index = numpy.repeat(numpy.arange(len(series)), lengths)
+    return (index, numpy.concatenate(periods), numpy.concatenate(values), lengths)
+
+  def latest(self, label: str, nitems: int):
+    # latest nitems values of every stock, newest first and zero padded
+    (_, _, values, lengths) = self.gather(label)
+    ends = numpy.cumsum(lengths)
+    data = numpy.zeros((len(self.stocks), nitems))
+    for k in range(nitems):
+      valid = lengths > k
+      data[valid, k] = values[ends[valid] - 1 - k]
+    return (data, numpy.minimum(lengths, nitems))
+
+  def latest_quarters(self, key: str, nitems: int = 4):
+    return self.latest(Stock.quarter_label(key), nitems)
+
+  def latest_year(self, key: str):
+    return self.latest(Stock.annual_label(key), 1)[0][:, 0]
+
+  def year_data(self, key: str, years: range):
+    # value of every stock in each of the years, 0 where missing
+    (index, periods, values, _) = self.gather(Stock.annual_label(key))
+    data = numpy.zeros((len(self.stocks), len(years)))
+    found = (periods >= years.start) & (periods < years.stop)
+    data[index[found], periods[found] - years.start] = values[found]
+    return data
+
+  @staticmethod
+  def ratio(numerator, denominator, valid):
+    return numpy.divide(numerator, denominator, out=numpy.zeros(len(numerator)), where=valid)
+
+  def screen(self):
+    n = len(self.stocks)
+
+    (eps, _) = self.latest_quarters(Stock.eps_key)
+    eps = row_sum(eps)
+    eps = numpy.where(eps != 0, eps, self.latest_year(Stock.eps_key))
+    self.pe = self.ratio(self.price / 100, eps, eps != 0)
+
+    (cash_flow, count) = self.latest_quarters(Stock.cash_flow_from_operations_key)
+    cash_flow = row_sum(cash_flow)
+    self.cfm = self.ratio(self.market_capital, cash_flow, (count >= 4) & (cash_flow != 0))
+
+    (operational_profit, op_count) = self.latest_quarters(Stock.operational_profit_key)
+    (sales, sales_count) = self.latest_quarters(Stock.sales_key)
+    (net_profit, np_count) = self.latest_quarters(Stock.net_profit_key)
+    (operational_profit, sales, net_profit) = (row_sum(operational_profit), row_sum(sales), row_sum(net_profit))
+    self.op2s = self.ratio(operational_profit, sales, (op_count >= 4) & (sales_count >= 4) & (sales != 0))
+    self.np2s = self.ratio(net_profit, sales, (np_count >= 4) & (sales_count >= 4) & (sales != 0))
+
+    dividends = self.year_data(Stock.dividend_key, range(2015,2019))
+    self.dividend_average = row_mean(dividends)
+    self.dividend_stdev = row_stdev(dividends)
+
+    returns = self.year_data(Stock.return_key, range(2015,2020))
+    self.average_return = row_mean(returns)
+    self.return_12month = returns[:, -1]
+
+    self.fail = numpy.zeros((n, len(Universe.criteria)), dtype=bool)
+    self.fail[:, 0] = self.pe > 15
+    self.fail[:, 1] = self.cfm > self.pe
+    self.fail[:, 2] = self.cfm < 0
+    self.fail[:, 3] = self.op2s < 0.10
+    self.fail[:, 4] = self.np2s < 0.04
+    self.fail[:, 5] = self.dividend_average < 3
+    self.fail[:, 6] = self.average_return < 10
+    self.fail[:, 7] = self.dividend_average > 0.5 * self.average_return
+    self.fail[:, 8] = self.return_12month < 10
+
+    weights = numpy.array([criterion[0] for criterion in Universe.criteria], dtype=numpy.float64)
+    failed_weights = numpy.where(self.fail, weights, 1).prod(axis=1)
+    self.score = numpy.where(self.fail.any(axis=1), failed_weights, 15 - self.pe)
+
+  def threshold_margins(self):
+    # how far each stock's screen inputs are from the thresholds screen
+    # compares them with, relative to the threshold (stocks x criteria);
+    # comparisons with 0 have no relative margin and count as far
+    pairs = [
+      (self.pe, 15),
+      (self.cfm, self.pe),
+      (self.cfm, 0),
+      (self.op2s, 0.10),
+      (self.np2s, 0.04),
+      (self.dividend_average, 3),
+      (self.average_return, 10),
+      (self.dividend_average, 0.5 * self.average_return),
+      (self.return_12month, 10),
+    ]
+    margins = numpy.full((len(self.stocks), len(pairs)), numpy.inf)
+    for k, (value, threshold) in enumerate(pairs):
+      threshold = numpy.broadcast_to(numpy.abs(threshold), value.shape)
+      numpy.divide(numpy.abs(value - threshold), threshold, out=margins[:, k], where=threshold != 0)
+    return margins
+
+  def get_fail(self, i: int) -> []:
+    return [criterion for (criterion, failed) in zip(Universe.criteria, self.fail[i]) if failed]
+
+  def get_sorted_stocks(self) -> []:
+    # highest score first, stocks with equal scores keep their order
+    return [self.stocks[i] for i in numpy.argsort(-self.score, kind='stable')]
 
 def to_float(s: str) -> float:
   if s == "--":
@@ -432,51 +909,256 @@ def get_value(driver, path) -> float:
   element = driver.find_element_by_xpath(path)
   return to_float(element.text)
 
-def scrub_prices(stocks):
+# name -> seconds each wait took until the page was ready
+wait_times = {}
+
+def wait_until(driver, name: str, condition):
+  # Polls condition(driver) until it returns a true value and returns it.
+  # Elements that are missing or replaced while polling count as not ready,
+  # after args.wait_timeout seconds a TimeoutException is raised.
+  start = time.perf_counter()
+  wait = WebDriverWait(driver, args.wait_timeout, poll_frequency=0.1,
+                       ignored_exceptions=(NoSuchElementException, StaleElementReferenceException))
+  result = wait.until(condition, "%s not ready after %gs" % (name, args.wait_timeout))
+  wait_times.setdefault(name, []).append(time.perf_counter() - start)
+  return result
+
+def get_wait_stats() -> {}:
+  # name -> (number of waits, mean seconds, max seconds)
+  return dict((name, (len(times), statistics.mean(times), max(times))) for name, times in wait_times.items())
+
+def print_scrub_stats():
+  for name, (count, mean, longest) in sorted(get_wait_stats().items()):
+    print("%-16s %5d waits, mean %.2fs, max %.2fs" % (name, count, mean, longest))
+  if plan_counts:
+    print("%-16s %s" % ("plans", ", ".join("%s %d" % (plan, count) for plan, count in sorted(plan_counts.items()))))
+  if rpc_counts:
+    print("%-16s %5d stocks, mean %.1f, max %d WebDriver commands" % ("rpcs", len(rpc_counts), statistics.mean(rpc_counts), max(rpc_counts)))
+
+# Reads every table matching an xpath in one WebDriver call: the left edge of
+# the table (0 for hidden tabs) and the texts of its cells, the th cells of
+# the heading row and the td cells of the other rows, or the td cells of every
+# row without a heading.
+table_cells_script = """
+var result = document.evaluate(arguments[0], document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var tables = [];
+for (var i = 0; i < result.snapshotLength; i++) {
+  var table = result.snapshotItem(i);
+  var rows = table.getElementsByTagName("tr");
+  var cells = [];
+  for (var r = 0; r < rows.length; r++) {
+    var tag = (r == 0 && arguments[1]) ? "th" : "td";
+    cells.push(Array.prototype.map.call(rows[r].getElementsByTagName(tag), function(cell) { return cell.innerText.trim(); }));
+  }
+  tables.push([table.getBoundingClientRect().left + window.pageXOffset, cells]);
+}
+return tables;
+"""
+
+def read_tables(driver, path: str, heading: bool = True) -> []:
+  # (x, cells) of every table matching the xpath
+  return driver.execute_script(table_cells_script, path, heading)
+
+def shown_table(driver, path: str, nrows: int):
+  # cells of the shown table matching the xpath once its first nrows rows are
+  # rendered, None before that
+  for (x, cells) in read_tables(driver, path):
+    if x == 0: continue
+    if len(cells) >= nrows and any(cells[nrows - 1]):
+      return cells
+  return None
+
+# filename -> page_cache.PageCache opened by this process
+page_caches = {}
+
+def get_page_cache():
+  # the --page_cache of this process, None without one
+  if not args.page_cache:
+    return None
+  if args.page_cache not in page_caches:
+    page_caches[args.page_cache] = page_cache.PageCache(args.page_cache)
+  return page_caches[args.page_cache]
+
+def cache_page(driver, url: str, state: str = ""):
+  cache = get_page_cache()
+  if cache is not None:
+    cache.put(url, driver.page_source, state)
+
+# WebDriver commands each scrub_stock call sent
+rpc_counts = []
+
+def count_rpcs(driver):
+  # every WebDriver command, also those of elements, goes through
+  # driver.execute: count them in driver.rpc_count
+  execute = driver.execute
+  def counted_execute(driver_command, params = None):
+    driver.rpc_count += 1
+    return execute(driver_command, params)
+  driver.execute = counted_execute
+  driver.rpc_count = 0
+  return driver
+
+def open_driver():
   locale.setlocale( locale.LC_ALL, 'en_US.UTF-8' ) 
-  driver = webdriver.Chrome(executable_path = 'C:/Program Files (x86)/Google/Chrome/Application/chromedriver.exe')
-  driver.get("https://info.tase.co.il/heb/marketdata/stocks/marketdata/Pages/MarketData.aspx")
-  time.sleep(2)
-
-  f = open("test1.txt", "wb")
-
-  for page in range(1,10):
-
-    row = 2
-    while 1:
-      path = '*[@id="ctl00_ctl40_g_55dc650a_ae63_4190_ad5a_3c40a8114974_ctl00_ucGridAllShares_DataGrid1"]/tbody/tr[%d]' % row
-      path = '*[@id="*_ucGridAllShares_DataGrid1"]/tbody/tr[%d]' % row
-      path = '//*[contains(@id, "_ucGridAllShares_DataGrid1")]/tbody/tr[%d]' % row
+  return limit_requests(count_rpcs(webdriver.Chrome(executable_path = 'C:/Program Files (x86)/Google/Chrome/Application/chromedriver.exe')))
+
+# The rate_limit.RateLimiter every request of this process waits for. With
+# parallel workers it is a proxy of the one the main process shares.
+rate_limiter = None
+
+def get_rate_limiter():
+  global rate_limiter
+  if rate_limiter is None:
+    if args.scrub_workers > 1:
+      manager = rate_limit.SharedLimiter()
+      manager.start()
+      rate_limiter = manager.RateLimiter(args.rate_limit, args.max_in_flight)
+    else:
+      rate_limiter = rate_limit.RateLimiter(args.rate_limit, args.max_in_flight)
+  return rate_limiter
+
+def limit_requests(driver):
+  # page loads wait for the rate limiter of their host
+  get = driver.get
+  def limited_get(url: str):
+    with rate_limit.Limited(get_rate_limiter(), url):
+      get(url)
+  driver.get = limited_get
+  return driver
+
+def print_limiter_stats():
+  # per host request rate, latency percentiles and the adapted limits, also
+  # written to --limiter_stats as json
+  if rate_limiter is None:
+    return
+  stats = rate_limiter.get_stats()
+  for host, host_stats in sorted(stats.items()):
+    print("%s: %d requests (%d errors), %.2f/s, latency p50 %.2fs p90 %.2fs p99 %.2fs, limits %.2f/s %d in flight" % (
+      host, host_stats['requests'], host_stats['errors'], host_stats['requests_per_second'],
+      host_stats['latency_p50'], host_stats['latency_p90'], host_stats['latency_p99'],
+      host_stats['rate'], host_stats['in_flight_limit']))
+  if args.limiter_stats:
+    f = open(args.limiter_stats, "w", encoding='utf-8')
+    json.dump(stats, f, indent=2, sort_keys=True)
+    f.close()
 
-      price_path = path + "/td[6]" # + "/td[6]/div"
-      stock_id_path = path + "/td[8]" # /div"
-      market_capital_path = path + "/td[8]" # /div"
+# The shares grid of the TASE market data page, paged by numbered links below
+# it. A data row holds the price in its 6th cell and the stock id in its 8th,
+# the heading and pager rows do not parse and are skipped.
+prices_url = "https://info.tase.co.il/heb/marketdata/stocks/marketdata/Pages/MarketData.aspx"
+prices_grid_path = '//table[contains(@id, "_ucGridAllShares_DataGrid1")]'
 
-      try:
-        stock_id_result = driver.find_element_by_xpath(stock_id_path)
-        price_result = driver.find_element_by_xpath(price_path)
-        market_capital_result = driver.find_element_by_xpath(market_capital_path)
-      except:
-        break
+def parse_price_rows(rows: []) -> []:
+  # (stock id, price) of every data row of a grid page
+  prices = []
+  for row in rows:
+    if len(row) < 8: continue
+    try:
+      prices.append((int(row[7]), float(row[5].replace(',', ''))))
+    except ValueError:
+      continue
+  return prices
+
+def read_price_grid(driver, previous: []):
+  # the prices of the shown grid page, in one WebDriver call; None while the
+  # grid is empty or still shows the previous page
+  for (x, rows) in read_tables(driver, prices_grid_path, False):
+    prices = parse_price_rows(rows)
+    if prices and (not previous or prices[0] != previous[0]):
+      return prices
+  return None
+
+def scrub_price_grid() -> []:
+  # (stock id, price) of every row of every grid page
+  driver = open_driver()
+  driver.get(prices_url)
+
+  prices = []
+  page = wait_until(driver, "prices", lambda driver: read_price_grid(driver, None))
+  number = 1
+  while True:
+    prices += page
+    links = driver.find_elements_by_link_text("%d" % (number + 1))
+    if not links:
+      break
+    # the click posts back to the site, the grid of the next page replaces
+    # the rows of this one
+    with rate_limit.Limited(get_rate_limiter(), prices_url):
+      links[0].click()
+      page = wait_until(driver, "prices page", lambda driver: read_price_grid(driver, page))
+    number += 1
 
-      stock_id = int(stock_id_result.text)
-      price = float(price_result.text.replace(',', ''))
-      market_capital = float(market_capital_result.text.replace(',', ''))
+  driver.quit()
+  print_scrub_stats()
+  print_limiter_stats()
+  return prices
+
+# Column headings of a bulk price file (--prices_file), a CSV file with a
+# heading row: stock_id,price or the end of day export of the TASE site. The
+# headings are matched ignoring case and spaces around them, the title lines
+# the export has above its heading row are skipped.
+price_file_columns = {
+  'stock_id': ("stock_id", "id", "security number", "security no.", "מספר נייר", "מס' נייר", "מספר ני\"ע", "מס' ני\"ע"),
+  'price':    ("price", "closing price", "close", "last price", "שער סגירה", "שער אחרון", "שער"),
+}
+
+def read_prices_file(filename: str) -> []:
+  # (stock id, price) of every row of the file
+  data = open(filename, "rb").read()
+  try:
+    text = data.decode("utf-8-sig")
+  except UnicodeDecodeError:
+    # the export of the TASE site is in the Windows Hebrew code page
+    text = data.decode("cp1255")
 
-      f.write(("%s: %s\n" % (stock_id, price)).encode("utf-8"))
+  rows = csv.reader(text.splitlines())
+  columns = None
+  for row in rows:
+    headings = [heading.strip().lower() for heading in row]
+    found = [next((i for i, heading in enumerate(headings) if heading in names), None) for names in price_file_columns.values()]
+    if None not in found:
+      columns = found
+      break
+  if columns is None:
+    raise ValueError("%s: no heading row with %s columns" % (filename, " and ".join(price_file_columns.keys())))
+
+  (id_column, price_column) = columns
+  prices = []
+  for row in rows:
+    if len(row) <= max(columns): continue
+    try:
+      prices.append((int(row[id_column]), float(row[price_column].replace(',', ''))))
+    except ValueError:
+      continue
+  return prices
 
-      stocks[stock_id].set_price(price)
+def scrub_prices(stocks):
+  # Sets the price of every stock at once, from the TASE shares grid or from
+  # --prices_file. Market capitals follow from the prices, the number of
+  # shares of a stock is read with its other data.
+  start = time.perf_counter()
+  if args.prices_file:
+    prices = read_prices_file(args.prices_file)
+  else:
+    prices = scrub_price_grid()
 
-      row = row + 1
+  f = open("test1.txt", "wb")
+  unknown = 0
+  for (stock_id, price) in prices:
+    f.write(("%s: %s\n" % (stock_id, price)).encode("utf-8"))
+    if stock_id not in stocks:
+      unknown += 1
+      continue
+    stocks[stock_id].set_price(price)
+  f.close()
 
-    if page < 9:
-      # click next page number
-      element = driver.find_element_by_link_text("%d" % (page+1))
-      element.click()
-      time.sleep(4)
+  print("prices: %d stocks in %.2fs, %d not in the stock data" % (len(prices) - unknown, time.perf_counter() - start, unknown), flush=True)
 
-  f.close()
-  driver.quit()
+# tables and values of the bizportal quote pages
+dividends_table_path = "//article[@class='center-part section-container']/div/div/div[4]/div/table/tbody"
+returns_table_path = "//article[@class='center-part section-container']/div/div[1]/div[1]/div/div[2]/table/tbody"
+price_value_path = "//div[@class='col-lg-6 no-padding paper-data']/div/div[2]/ul/li[1]/span[@class='num']"
+market_capital_value_path = "//div[@class='col-lg-6 no-padding paper-data']/div/div[2]/ul/li[7]/span[@class='num']"
 
 def scrub_stock(driver, stock: Stock):
 
@@ -484,7 +1166,17 @@ def scrub_stock(driver, stock: Stock):
   #f.close()
 
   stock_id = stock.get_id()
+  plan = scrape_plan(stock)
+
+  # every page still fresh in the cache: no need for the browser
+  cache = get_page_cache()
+  if cache is not None:
+    import http_fetch   # needs lxml, not aiohttp
+    pages = http_fetch.cached_stock(cache, "https://www.bizportal.co.il", stock_id)
+    if pages is not None:
+      return load_fetched_pages(stock, pages, plan)
 
+  rpc_start = driver.rpc_count
 
   general_view_path = "https://www.bizportal.co.il/capitalmarket/quote/generalview/%d" % stock_id
   profile_path      = "https://www.bizportal.co.il/capitalmarket/quote/profile/%d" % stock_id
@@ -493,145 +1185,66 @@ def scrub_stock(driver, stock: Stock):
   # reports
   # -------
   reports_path = "https://www.bizportal.co.il/capitalmarket/quote/reports/%d" % stock_id
-  driver.get(reports_path)
-  time.sleep(4)
-
-  results = driver.find_elements_by_xpath("//table[@id='profit-and-loss-report']")
-  for result in results:
-    # skip hidden data
-    if result.location['x'] == 0: continue
-
-    rows = result.find_elements(By.TAG_NAME, "tr") # get all of the rows in the table
-
-    # Process heading
-    years = []
-    quarters = []
-    cols = rows[0].find_elements(By.TAG_NAME, "th")
-    for ci in range(0,len(cols)):
-      m = re.match(r'Q(\d)\/(\d+)', cols[ci].text)
-      if m:
-        quarters.append(int("0"+m.group(1)))
-        years.append(int("0"+m.group(2)))
-      else:
-        quarters.append(0)
-        years.append(0)
-
-    cols = rows[1].find_elements(By.TAG_NAME, "td")
-    for ci in range(1,len(cols)):
-      stock.set_quarter_data(Stock.sales_key, years[ci], quarters[ci], to_float(cols[ci].text))
-
-    cols = rows[3].find_elements(By.TAG_NAME, "td")
-    for ci in range(1,len(cols)):
-      stock.set_quarter_data(Stock.operational_profit_key, years[ci], quarters[ci], to_float(cols[ci].text))
-
-    cols = rows[6].find_elements(By.TAG_NAME, "td")
-    for ci in range(1,len(cols)):
-      stock.set_quarter_data(Stock.net_profit_key, years[ci], quarters[ci], to_float(cols[ci].text))
-
-    cols = rows[9].find_elements(By.TAG_NAME, "td")
-    for ci in range(1,len(cols)):
-      stock.set_quarter_data(Stock.eps_key, years[ci], quarters[ci], to_float(cols[ci].text))
-
-
-  results = driver.find_elements_by_xpath("//table[@id='cash-flow-report']")
-  for result in results:
-    # skip hidden data
-    if result.location['x'] == 0: continue
-
-    rows = result.find_elements(By.TAG_NAME, "tr") # get all of the rows in the table
-
-    # Process heading
-    years = []
-    quarters = []
-    cols = rows[0].find_elements(By.TAG_NAME, "th")
-    for ci in range(0,len(cols)):
-      m = re.match(r'Q(\d)\/(\d+)', cols[ci].text)
-      try:
-        quarters.append(int("0"+m.group(1)))
-        years.append(int("0"+m.group(2)))
-      except:
-        quarters.append(0)
-        years.append(0)
-
-    # Cash flow from operations is row 1
-    cols = rows[1].find_elements(By.TAG_NAME, "td")
-    for ci in range(1,len(cols)):
-      stock.set_quarter_data(Stock.cash_flow_from_operations_key, years[ci], quarters[ci], to_float(cols[ci].text))
-
-
-  # click for annual data
-  element = driver.find_element_by_css_selector("li[aria-controls='profit-and-loss-report-tabstrip-2']")
-  element.click()
-  time.sleep(4)
-
-  results = driver.find_elements_by_xpath("//table[@id='profit-and-loss-report']")
-  for result in results:
-    # skip hidden table (which is the quarterly values)
-    if result.location['x'] == 0: continue
-
-    rows = result.find_elements(By.TAG_NAME, "tr") # get all of the rows in the table
-
-    # Process heading
-    years = []
-    cols = rows[0].find_elements(By.TAG_NAME, "th")
-    for ci in range(0, len(cols)):
-      year = "0"+cols[ci].text
-      years.append(int(year.replace('0Y/','')))
-      #f.write(("th (%d) %s\n" % (ci, cols[ci].text)).encode("utf-8"))
-      #annual_data.append({})
-      #annual_data[ci-1]['year'] = cols[ci].text
-
-    # EPS is row 9
-    cols = rows[9].find_elements(By.TAG_NAME, "td")
-    for ci in range(1, len(cols)):
-      stock.set_annual_data(Stock.eps_key, years[ci], to_float(cols[ci].text))
-
-    # Earnings is row 1
-    cols = rows[1].find_elements(By.TAG_NAME, "td")
-    for ci in range(1, len(cols)):
-      stock.set_annual_data(Stock.earnings_key, years[ci], to_float(cols[ci].text))
-
-    # Operational profit is row 3
-    cols = rows[3].find_elements(By.TAG_NAME, "td")
-    for ci in range(1, len(cols)):
-      stock.set_annual_data(Stock.operational_profit_key, years[ci], to_float(cols[ci].text))
-
-  # performance
-  # -----------
-  driver.get(performance_path)
-  time.sleep(2)
+  if plan != 'price':
+    driver.get(reports_path)
+    # quarterly profit and loss, rows up to EPS (row 9)
+    quarterly = wait_until(driver, "reports", lambda driver: shown_table(driver, "//table[@id='profit-and-loss-report']", 10))
+    cache_page(driver, reports_path)
+
+    # cash flow from operations is row 1
+    cash_flow = shown_table(driver, "//table[@id='cash-flow-report']", 2)
+
+    new_hash = reports_hash(quarterly, cash_flow)
+    if plan == 'check' and new_hash == stock.get_info('+reports_hash'):
+      # nothing reported since the last scrape
+      plan = 'price'
+    elif plan == 'check':
+      plan_counts['changed'] = plan_counts.get('changed', 0) + 1
+
+  if plan != 'price':
+    load_quarter_table(stock, quarterly, profit_and_loss_quarter_rows)
+    if cash_flow is not None:
+      load_quarter_table(stock, cash_flow, cash_flow_quarter_rows)
+
+    # click for annual data
+    element = driver.find_element_by_css_selector("li[aria-controls='profit-and-loss-report-tabstrip-2']")
+
+    def annual_table(driver):
+      # the annual table is shown in place of the quarterly one
+      cells = shown_table(driver, "//table[@id='profit-and-loss-report']", 10)
+      if cells is not None and cells[0] != quarterly[0]:
+        return cells
+      return None
+
+    # the tab loads the annual reports from the site
+    with rate_limit.Limited(get_rate_limiter(), reports_path):
+      element.click()
+      annual = wait_until(driver, "annual tab", annual_table)
+    load_annual_table(stock, annual, profit_and_loss_annual_rows)
+    cache_page(driver, reports_path, "annual")
 
-  try:
-    result = driver.find_element_by_xpath("//article[@class='center-part section-container']/div/div/div[4]/div/table/tbody")
-    rows = result.find_elements(By.TAG_NAME, "tr") # get all of the rows in the table
-    for row in rows:
-      cols = row.find_elements(By.TAG_NAME, "td")
-      stock.set_annual_data(Stock.dividend_key, locale.atoi(cols[0].text), locale.atof(cols[4].text))
-  except:
-    i = 1
-    
-  result = driver.find_element_by_xpath("//article[@class='center-part section-container']/div/div[1]/div[1]/div/div[2]/table/tbody")
-  rows = result.find_elements(By.TAG_NAME, "tr") # get all of the rows in the table
+    # performance
+    # -----------
+    driver.get(performance_path)
+    returns = wait_until(driver, "performance", lambda driver: [cells for (x, cells) in read_tables(driver, returns_table_path, False) if cells])
+    cache_page(driver, performance_path)
 
-  first_row = True
-  for row in rows:
-    cols = row.find_elements(By.TAG_NAME, "td")
+    try:
+      load_dividends(stock, read_tables(driver, dividends_table_path, False)[0][1])
+    except:
+      i = 1
 
-    # first row is last 12 months -> use as 2019 value
-    if first_row:
-      stock.set_annual_data(Stock.return_key, 2019, to_float(cols[1].text))
-      first_row = False
+    load_returns(stock, returns[0])
 
-    m = re.search(r'(20\d+)', cols[0].text)
-    if m:
-      stock.set_annual_data(Stock.return_key, int(m.group(1)), to_float(cols[1].text))
+    record_reports(stock, new_hash)
 
   # get price, market_capital
   # -------------------------
   driver.get(general_view_path)
-  time.sleep(2)
-  price = get_value(driver, "//div[@class='col-lg-6 no-padding paper-data']/div/div[2]/ul/li[1]/span[@class='num']")
-  market_capital = get_value(driver, "//div[@class='col-lg-6 no-padding paper-data']/div/div[2]/ul/li[7]/span[@class='num']")
+  wait_until(driver, "general view", lambda driver: driver.find_element(By.XPATH, price_value_path).text.strip() and driver.find_element(By.XPATH, market_capital_value_path).text.strip())
+  cache_page(driver, general_view_path)
+  price = get_value(driver, price_value_path)
+  market_capital = get_value(driver, market_capital_value_path)
 
   stock.set_price_and_market_capital(price, market_capital)
 
@@ -640,69 +1253,1024 @@ def scrub_stock(driver, stock: Stock):
   # driver.get(profile_path)
   # stock.set_name(get_string(driver, "//div[@class='content-area company-profile']/div/div/div/div[12]"))
 
+  rpc_counts.append(driver.rpc_count - rpc_start)
+  return stock
+
+# Report tables as cell texts: the th cells of the heading row followed by the
+# td cells of every other row. Data rows start with their label column.
+
+# (row, key) of the values read from each report
+profit_and_loss_quarter_rows = ((1, Stock.sales_key), (3, Stock.operational_profit_key), (6, Stock.net_profit_key), (9, Stock.eps_key))
+profit_and_loss_annual_rows = ((9, Stock.eps_key), (1, Stock.earnings_key), (3, Stock.operational_profit_key))
+cash_flow_quarter_rows = ((1, Stock.cash_flow_from_operations_key),)
+
+def is_quarter_heading(heading: []) -> bool:
+  return any(re.match(r'Q(\d)\/(\d+)', text) for text in heading)
+
+def load_quarter_table(stock: Stock, cells: [], rows: ()):
+  years = []
+  quarters = []
+  for text in cells[0]:
+    m = re.match(r'Q(\d)\/(\d+)', text)
+    if m:
+      quarters.append(int("0"+m.group(1)))
+      years.append(int("0"+m.group(2)))
+    else:
+      quarters.append(0)
+      years.append(0)
+
+  for (row, key) in rows:
+    for ci in range(1, len(cells[row])):
+      stock.set_quarter_data(key, years[ci], quarters[ci], to_float(cells[row][ci]))
+
+def load_annual_table(stock: Stock, cells: [], rows: ()):
+  years = [int(("0"+text).replace('0Y/','')) for text in cells[0]]
+
+  for (row, key) in rows:
+    for ci in range(1, len(cells[row])):
+      stock.set_annual_data(key, years[ci], to_float(cells[row][ci]))
+
+def load_dividends(stock: Stock, cells: []):
+  # td cells of the dividends table body: year, ..., dividend in column 4
+  for cols in cells:
+    stock.set_annual_data(Stock.dividend_key, locale.atoi(cols[0]), locale.atof(cols[4]))
+
+def load_returns(stock: Stock, cells: []):
+  # td cells of the returns table body, the first row is the last 12 months
+  # and is used as the 2019 value
+  first_row = True
+  for cols in cells:
+    if first_row:
+      stock.set_annual_data(Stock.return_key, 2019, to_float(cols[1]))
+      first_row = False
+
+    m = re.search(r'(20\d+)', cols[0])
+    if m:
+      stock.set_annual_data(Stock.return_key, int(m.group(1)), to_float(cols[1]))
+
+def load_stock_pages(stock: Stock, pages: {}):
+  # Fills the stock from the parsed pages of http_fetch. The annual profit
+  # and loss table is in 'reports annual', what the annual tab loaded or the
+  # reports page the browser cached with that tab shown; the quarterly and
+  # annual tables are told apart by their heading. Pages that were not
+  # fetched are skipped. Reports without the annual table raise a ValueError
+  # before the stock is changed, so they are not taken for a full read.
+  import http_fetch
+
+  reports = [pages[name] for name in ('reports', 'reports annual') if name in pages]
+  quarterly = []
+  annual = []
+  for document in reports:
+    for table in document.xpath("//table[@id='profit-and-loss-report']"):
+      cells = http_fetch.table_cells(table)
+      if len(cells) < 10: continue
+      (quarterly if is_quarter_heading(cells[0]) else annual).append(cells)
+  if reports and not annual:
+    raise ValueError("reports page of %d has no annual profit and loss table" % stock.get_id())
+
+  for cells in quarterly:
+    load_quarter_table(stock, cells, profit_and_loss_quarter_rows)
+  for cells in annual:
+    load_annual_table(stock, cells, profit_and_loss_annual_rows)
+
+  for document in reports[:1]:
+    for table in document.xpath("//table[@id='cash-flow-report']"):
+      cells = http_fetch.table_cells(table)
+      if len(cells) > 1 and is_quarter_heading(cells[0]):
+        load_quarter_table(stock, cells, cash_flow_quarter_rows)
+
+  if 'performance' in pages:
+    try:
+      load_dividends(stock, http_fetch.body_cells(pages['performance'].xpath(dividends_table_path)[0]))
+    except:
+      i = 1
+
+    load_returns(stock, http_fetch.body_cells(pages['performance'].xpath(returns_table_path)[0]))
+
+  price = to_float(http_fetch.text(pages['general_view'].xpath(price_value_path)[0]))
+  market_capital = to_float(http_fetch.text(pages['general_view'].xpath(market_capital_value_path)[0]))
+  stock.set_price_and_market_capital(price, market_capital)
+
+  return stock
+
+# Incremental scraping (--incremental): fundamentals change once a quarter,
+# so a stock's reports are only read again once its next quarter may have
+# been reported, and the rest of its pages only if the quarterly tables
+# changed. Every --full_scrape_days a stock is scraped in full. The hash of
+# the quarterly tables and the date of the last full read are kept in the
+# '+reports_hash' and '+reports_date' info fields.
+
+# days after the end of a quarter its reports may come out
+report_lag_days = 30
+
+# plan -> number of stocks scraped with it, 'changed' counts the checks that
+# found new reports
+plan_counts = {}
+
+def quarter_end(year: int, quarter: int) -> datetime.date:
+  return datetime.date(year + quarter // 4, quarter % 4 * 3 + 1, 1) - datetime.timedelta(days=1)
+
+def scrape_plan(stock: Stock, today: datetime.date = None) -> str:
+  # 'full' reads every page, 'check' reads the quarterly reports and the rest
+  # only if they changed, 'price' reads just the general view
+  plan = 'full'
+  if today is None: today = datetime.date.today()
+
+  scraped = stock.get_info('+reports_date')
+  if args.incremental and scraped is not None and (today - datetime.date.fromisoformat(scraped)).days < args.full_scrape_days:
+    plan = 'check'
+    quarters = stock.get_series(Stock.quarter_label(Stock.sales_key))
+    if quarters is not None and len(quarters):
+      latest = int(quarters.periods[-1])
+      (year, quarter) = (latest // 10, latest % 10)
+      (year, quarter) = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
+      if today < quarter_end(year, quarter) + datetime.timedelta(days=report_lag_days):
+        plan = 'price'
+
+  plan_counts[plan] = plan_counts.get(plan, 0) + 1
+  return plan
+
+def reports_hash(quarterly: [], cash_flow: []) -> str:
+  return hashlib.sha1(repr((quarterly, cash_flow)).encode("utf-8")).hexdigest()[:16]
+
+def page_reports_hash(pages: {}) -> str:
+  # reports_hash of the quarterly tables of a parsed reports page
+  import http_fetch
+  tables = []
+  for path, nrows in (("//table[@id='profit-and-loss-report']", 10), ("//table[@id='cash-flow-report']", 2)):
+    found = None
+    for table in pages['reports'].xpath(path):
+      cells = http_fetch.table_cells(table)
+      if len(cells) >= nrows and is_quarter_heading(cells[0]):
+        found = cells
+        break
+    tables.append(found)
+  return reports_hash(*tables)
+
+def record_reports(stock: Stock, new_hash: str):
+  stock.set_info('+reports_hash', new_hash)
+  stock.set_info('+reports_date', datetime.date.today().isoformat())
+
+def load_fetched_pages(stock: Stock, pages: {}, plan: str):
+  # load_stock_pages, recording the reports when read in full or changed;
+  # reports that did not load are not recorded
+  load_stock_pages(stock, pages)
+  if 'reports' in pages:
+    new_hash = page_reports_hash(pages)
+    if plan == 'full' or new_hash != stock.get_info('+reports_hash'):
+      if plan == 'check':
+        plan_counts['changed'] = plan_counts.get('changed', 0) + 1
+      record_reports(stock, new_hash)
   return stock
 
-def scrub_all(stocks, start: int):
+def scrub_http(stocks, stock_ids: [], deadline: float = None, run = None):
+  # Fetches the pages of the stocks without a browser (--fetcher http), the
+  # stocks are filled and journaled as their pages arrive. Stocks are started
+  # in order until the deadline.
+  import http_fetch   # needs aiohttp and lxml
+
   locale.setlocale( locale.LC_ALL, 'en_US.UTF-8' ) 
-  driver = webdriver.Chrome(executable_path = 'C:/Program Files (x86)/Google/Chrome/Application/chromedriver.exe')
+  journal = open_journal(args.write_stock_data)
+  failed = []
 
-  for stock_id in sorted(stocks.keys()):
-    if stock_id < start: continue
-    if stocks[stock_id].skip(): continue
-    print("processing stock: %d" % stock_id, flush=True)
-    scrub_stock(driver, stocks[stock_id])
-    
-    write_stock_data(stocks)
+  # only the general view of stocks that have nothing new to report
+  plans = dict((stock_id, scrape_plan(stocks[stock_id])) for stock_id in stock_ids)
+  page_names = dict((stock_id, ['general_view']) for stock_id in stock_ids if plans[stock_id] == 'price')
 
-  driver.quit()
+  def handle(stock_id, pages, error):
+    if error is None:
+      try:
+        load_fetched_pages(stocks[stock_id], pages, plans[stock_id])
+      except Exception as load_error:
+        error = load_error
+    record_scrape(stocks[stock_id], error is None)
+    journal.append(stocks[stock_id])
+    if run is not None: run.mark(stock_id, error is None)
+    handled.append(stock_id)
+    if error is not None:
+      print("failed stock: %d: %r" % (stock_id, error), flush=True)
+      failed.append(stock_id)
+      return False
+    print("processed stock: %d" % stock_id, flush=True)
+    return True
+
+  handled = []
+  http_fetch.fetch_all(stock_ids, handle, args.base_url, args.http_connections, args.wait_timeout, get_page_cache(), page_names, deadline, get_rate_limiter())
+  journal.close()
+  print_scrub_stats()
+
+  if len(handled) < len(stock_ids):
+    print("scrub budget used up, %d stocks not scraped" % (len(stock_ids) - len(handled)))
+
+  if failed:
+    print("failed stocks: %s" % " ".join(str(stock_id) for stock_id in failed))
+
+def scrub_replay(stocks, stock_ids: []):
+  # Parses the stocks from the --page_cache alone, however old the pages are
+  # (--fetcher replay). Nothing is fetched.
+  import http_fetch
 
-def scrub_one(stocks, stock_id: int):
   locale.setlocale( locale.LC_ALL, 'en_US.UTF-8' ) 
-  driver = webdriver.Chrome(executable_path = 'C:/Program Files (x86)/Google/Chrome/Application/chromedriver.exe')
+  cache = get_page_cache()
+  journal = open_journal(args.write_stock_data)
+  missing = []
+  failed = []
+
+  for stock_id in stock_ids:
+    pages = http_fetch.cached_stock(cache, args.base_url, stock_id, fresh=False)
+    if pages is None:
+      missing.append(stock_id)
+      continue
+    try:
+      load_stock_pages(stocks[stock_id], pages)
+    except Exception as error:
+      print("failed stock: %d: %r" % (stock_id, error), flush=True)
+      failed.append(stock_id)
+      continue
+    journal.append(stocks[stock_id])
+
+  journal.close()
+
+  if missing:
+    print("stocks not in the page cache: %s" % " ".join(str(stock_id) for stock_id in missing))
+  if failed:
+    print("failed stocks: %s" % " ".join(str(stock_id) for stock_id in failed))
+
+def scrub_one(stocks, stock_id: int):
+  if args.fetcher == "http":
+    scrub_http(stocks, [stock_id])
+    return print_limiter_stats()
+  if args.fetcher == "replay":
+    return scrub_replay(stocks, [stock_id])
+
+  driver = open_driver()
 
   print("processing stock: %d" % stock_id, flush=True)
   scrub_stock(driver, stocks[stock_id])
-  write_stock_data(stocks)
+  record_scrape(stocks[stock_id], True)
+
+  journal = open_journal(args.write_stock_data)
+  journal.append(stocks[stock_id])
+  journal.close()
 
   driver.quit()
+  print_scrub_stats()
+  print_limiter_stats()
+
+# Refresh order of scrub_all: the stocks that matter most are scraped first,
+# by a priority adding up
+#   staleness   days since the stock was last scraped ('+scraped'), in weeks,
+#               at most 4 (never scraped counts as 4)
+#   threshold   1 when a screen input sits on its fail threshold, falling to
+#               0 at 20% away from it
+#   watchlist   1 for the stocks of --watchlist
+#   failures    scrapes failed since the last good one ('+failures'), at most 4
+# each times its weight. --scrub_budget stops starting stocks after that many
+# minutes, so the most important stocks are refreshed within the budget.
+priority_weights = {'staleness': 1.0, 'threshold': 2.0, 'watchlist': 3.0, 'failures': 0.5}
+
+def read_watchlist(filename: str) -> set:
+  # stock ids, one per line, # starts a comment
+  if not filename:
+    return set()
+  f = open(filename, "r", encoding='utf-8')
+  ids = set(int(line.split("#")[0]) for line in f if line.split("#")[0].strip())
+  f.close()
+  return ids
+
+def refresh_priorities(stocks, stock_ids: [], now: datetime.datetime = None):
+  if now is None: now = datetime.datetime.now()
+  selected = [stocks[stock_id] for stock_id in stock_ids]
+
+  staleness = numpy.full(len(selected), 4.0)
+  failures = numpy.zeros(len(selected))
+  for i, stock in enumerate(selected):
+    scraped = stock.get_info('+scraped')
+    if scraped is not None:
+      age = now - datetime.datetime.strptime(scraped, "%Y-%m-%d %H:%M:%S")
+      staleness[i] = min(age.total_seconds() / (7 * 24 * 3600), 4.0)
+    failures[i] = min(int(stock.get_info('+failures', 0)), 4)
+
+  margins = Universe(dict(zip(stock_ids, selected))).threshold_margins()
+  threshold = numpy.clip(1 - margins.min(axis=1) / 0.2, 0, 1) if len(selected) else numpy.zeros(0)
+
+  watchlist = numpy.isin(numpy.array(stock_ids, dtype=numpy.int64), list(read_watchlist(args.watchlist)))
+
+  return (priority_weights['staleness'] * staleness +
+          priority_weights['threshold'] * threshold +
+          priority_weights['watchlist'] * watchlist +
+          priority_weights['failures'] * failures)
+
+def scrub_ids(stocks) -> []:
+  # the stocks scrub_all goes over, highest priority first
+  stock_ids = [stock_id for stock_id in sorted(stocks.keys()) if not stocks[stock_id].skip()]
+  priorities = refresh_priorities(stocks, stock_ids)
+  return [stock_ids[i] for i in numpy.argsort(-priorities, kind='stable')]
+
+def get_deadline():
+  # time.time() after which no more stocks are started, None without a budget
+  if args.scrub_budget:
+    return time.time() + args.scrub_budget * 60
+  return None
+
+def record_scrape(stock: Stock, ok: bool):
+  if ok:
+    stock.set_info('+scraped', time.strftime("%Y-%m-%d %H:%M:%S"))
+    stock.set_info('+failures', "0")
+  else:
+    stock.set_info('+failures', str(int(stock.get_info('+failures', 0)) + 1))
+
+class ScrapeRun():
+  # Checkpoint of a scrub_all run, <run_dir>/<run id>.run:
+  #
+  #   order <stock ids in the order they are scraped>
+  #   done <stock id>          one line per stock scraped,
+  #   failed <stock id>        written after the stock is journaled
+  #   finished
+  #
+  # Each line is on disk before the next stock is started, so --resume picks
+  # up exactly the stocks that are left, and failed stocks are tried again
+  # after all others.
+
+  suffix = ".run"
+
+  def __init__(self, filename: str) -> None:
+    self.filename = filename
+    self.run_id = os.path.basename(filename)[:-len(ScrapeRun.suffix)]
+    self.order = []
+    self.done = set()
+    self.attempts = {}    # stock id -> failed attempts
+    self.finished = False
+
+    if os.path.exists(filename):
+      f = open(filename, "r", encoding='utf-8')
+      for line in f:
+        if not line.endswith("\n"): break    # torn last line
+        parts = line.split()
+        if parts[0] == "order":
+          self.order = [int(stock_id) for stock_id in parts[1:]]
+        elif parts[0] == "done":
+          self.done.add(int(parts[1]))
+        elif parts[0] == "failed":
+          self.attempts[int(parts[1])] = self.attempts.get(int(parts[1]), 0) + 1
+        elif parts[0] == "finished":
+          self.finished = True
+      f.close()
 
-def scrub_all(stocks, start: int):
-  locale.setlocale( locale.LC_ALL, 'en_US.UTF-8' ) 
-  driver = webdriver.Chrome(executable_path = 'C:/Program Files (x86)/Google/Chrome/Application/chromedriver.exe')
+  @staticmethod
+  def start(directory: str, stock_ids: []):
+    os.makedirs(directory, exist_ok=True)
+    run = ScrapeRun(os.path.join(directory, time.strftime("%Y%m%d-%H%M%S") + ScrapeRun.suffix))
+    run.order = list(stock_ids)
+    run.write("order %s" % " ".join(str(stock_id) for stock_id in stock_ids))
+    return run
+
+  @staticmethod
+  def find(directory: str, run_id: str):
+    # the run with the id, or the latest run that did not finish for
+    # 'latest'; None if there is no such run
+    if run_id != "latest":
+      filename = os.path.join(directory, run_id + ScrapeRun.suffix)
+      return ScrapeRun(filename) if os.path.exists(filename) else None
+    names = sorted(name for name in os.listdir(directory) if name.endswith(ScrapeRun.suffix)) if os.path.isdir(directory) else []
+    for name in reversed(names):
+      run = ScrapeRun(os.path.join(directory, name))
+      if not run.finished:
+        return run
+    return None
+
+  def write(self, line: str):
+    f = open(self.filename, "a", encoding='utf-8')
+    f.write(line + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+  def mark(self, stock_id: int, ok: bool):
+    if ok:
+      self.done.add(stock_id)
+      self.write("done %d" % stock_id)
+    else:
+      self.attempts[stock_id] = self.attempts.get(stock_id, 0) + 1
+      self.write("failed %d" % stock_id)
+
+  def remaining(self, max_attempts: int) -> []:
+    # stocks not tried yet, then the failed ones with attempts left
+    untried = [stock_id for stock_id in self.order if stock_id not in self.done and stock_id not in self.attempts]
+    failed = [stock_id for stock_id in self.order if stock_id not in self.done and 0 < self.attempts.get(stock_id, 0) < max_attempts]
+    return untried + failed
+
+  def finish(self):
+    self.finished = True
+    self.write("finished")
+
+  def summary(self) -> str:
+    failed = [stock_id for stock_id in self.order if stock_id not in self.done and stock_id in self.attempts]
+    rv = "scrape run %s: %d of %d stocks done" % (self.run_id, len(self.done), len(self.order))
+    if failed:
+      rv += ", failed: %s" % " ".join(str(stock_id) for stock_id in failed)
+    return rv
+
+def scrub_all(stocks):
+  if args.fetcher == "replay":
+    return scrub_replay(stocks, scrub_ids(stocks))
+
+  run = None
+  if args.resume:
+    run = ScrapeRun.find(args.run_dir, args.resume)
+    if run is None:
+      print("no scrape run to resume", flush=True)
+      return
+  else:
+    run = ScrapeRun.start(args.run_dir, scrub_ids(stocks))
+  print("scrape run %s" % run.run_id, flush=True)
+
+  deadline = get_deadline()
+
+  # rounds over the stocks left, each retrying the failures of the last
+  while True:
+    stock_ids = [stock_id for stock_id in run.remaining(1 + args.scrub_retries) if stock_id in stocks]
+    if not stock_ids:
+      run.finish()
+      break
+    if deadline is not None and time.time() > deadline:
+      print("scrub budget used up", flush=True)
+      break
+
+    progress = (len(run.done), sum(run.attempts.values()))
+    if args.fetcher == "http":
+      scrub_http(stocks, stock_ids, deadline, run)
+    elif args.scrub_workers > 1:
+      scrub_all_parallel(stocks, stock_ids, args.scrub_workers, deadline, run)
+    else:
+      scrub_serial(stocks, stock_ids, deadline, run)
+
+    # a round that neither scraped nor failed a stock would repeat forever
+    if (len(run.done), sum(run.attempts.values())) == progress and (deadline is None or time.time() <= deadline):
+      print("error: scrape round made no progress, stopping", flush=True)
+      break
+
+  print(run.summary(), flush=True)
+  print_limiter_stats()
 
-  for stock_id in sorted(stocks.keys()):
-    if stock_id < start: continue
-    if stocks[stock_id].skip(): continue
+def scrub_serial(stocks, stock_ids: [], deadline: float = None, run: ScrapeRun = None):
+  driver = open_driver()
+
+  journal = open_journal(args.write_stock_data)
+
+  for stock_id in stock_ids:
+    if deadline is not None and time.time() > deadline:
+      break
     print("processing stock: %d" % stock_id, flush=True)
-    scrub_stock(driver, stocks[stock_id])
+    try:
+      scrub_stock(driver, stocks[stock_id])
+      ok = True
+    except Exception:
+      print("failed stock: %d\n%s" % (stock_id, traceback.format_exc()), flush=True)
+      ok = False
+    record_scrape(stocks[stock_id], ok)
     
-    write_stock_data(stocks)
+    journal.append(stocks[stock_id])
+    if run is not None:
+      run.mark(stock_id, ok)
 
+  journal.close()
   driver.quit()
+  print_scrub_stats()
+
+def scrub_worker(tasks, results, worker_args, limiter):
+  # Runs in a worker process with its own browser: takes (stock id, record)
+  # tasks until None and puts (stock id, scraped record, error) results. Its
+  # requests wait for the limiter shared by all workers.
+  global args, rate_limiter
+  args = worker_args
+  rate_limiter = limiter
+  driver = open_driver()
+
+  while True:
+    task = tasks.get()
+    if task is None: break
+    (stock_id, record) = task
+    try:
+      stock = scrub_stock(driver, Stock(stock_id).load_record(record))
+      results.put((stock_id, stock.get_record(), None))
+    except Exception:
+      results.put((stock_id, None, traceback.format_exc()))
 
-def read_stock_data():
-  stocks = {}
+  driver.quit()
+  print_scrub_stats()
+
+def scrub_all_parallel(stocks, stock_ids: [], nworkers: int, deadline: float = None, run: ScrapeRun = None):
+  # Every worker process scrapes the stocks it takes from one queue; this
+  # process is the only one that updates stocks, the journal and the run. The
+  # queue is kept two stocks per worker ahead, in order, until the stocks or
+  # the budget run out.
+
+  tasks = multiprocessing.Queue()
+  results = multiprocessing.Queue()
+  pending = iter(stock_ids)
+  outstanding = []    # queued stocks without a result yet
+  queued = 0
+  finished = False
+
+  def feed():
+    nonlocal queued, finished
+    if finished: return
+    stock_id = next(pending, None)
+    if stock_id is None or (deadline is not None and time.time() > deadline):
+      for i in range(nworkers):
+        tasks.put(None)
+      finished = True
+      return
+    tasks.put((stock_id, stocks[stock_id].get_record()))
+    outstanding.append(stock_id)
+    queued += 1
+
+  for i in range(2 * nworkers):
+    feed()
+
+  workers = [multiprocessing.Process(target=scrub_worker, args=(tasks, results, args, get_rate_limiter())) for i in range(nworkers)]
+  for worker in workers:
+    worker.start()
+
+  journal = open_journal(args.write_stock_data)
+
+  failed = []
+  done = 0
+  lost = []
+  while done < queued:
+    try:
+      (stock_id, record, error) = results.get(timeout=1)
+    except queue.Empty:
+      # a worker that died (or could not start its browser) takes its stock
+      # with it: once no worker is left, every stock queued without a result
+      # counts as a failed attempt
+      if not any(worker.is_alive() for worker in workers):
+        lost = [stock_id for stock_id in outstanding if stock_id in stocks]
+        break
+      continue
+    done += 1
+    outstanding.remove(stock_id)
+    feed()
+    if error is not None:
+      print("failed stock: %d\n%s" % (stock_id, error), flush=True)
+      failed.append(stock_id)
+      record_scrape(stocks[stock_id], False)
+      journal.append(stocks[stock_id])
+      if run is not None: run.mark(stock_id, False)
+      continue
+    print("processed stock: %d (%d/%d)" % (stock_id, done, len(stock_ids)), flush=True)
+    # only what the scrape changed is set, through the setters: a stock
+    # database then writes just those rows, once
+    stock = stocks[stock_id].update(Stock(stock_id).load_record(record))
+    record_scrape(stock, True)
+    journal.append(stock)
+    if run is not None: run.mark(stock_id, True)
+
+  # stocks lost on their first try, as when no browser starts at all
+  first_tries = [stock_id for stock_id in lost if run is None or stock_id not in run.attempts]
+  for stock_id in lost:
+    record_scrape(stocks[stock_id], False)
+    journal.append(stocks[stock_id])
+    if run is not None: run.mark(stock_id, False)
+
+  journal.close()
+  for worker in workers:
+    worker.join()
+
+  if lost:
+    print("all workers stopped, %d stocks got no result: %s" % (len(lost), " ".join(str(stock_id) for stock_id in lost)), flush=True)
+    if done == 0 and first_tries:
+      # not one result for new stocks: the workers cannot scrape at all
+      raise RuntimeError("scrape workers stopped without scraping a stock")
+  elif done < len(stock_ids):
+    print("scrub budget used up, %d stocks not scraped" % (len(stock_ids) - done))
+  if failed:
+    print("failed stocks: %s" % " ".join(str(stock_id) for stock_id in failed))
+
+class MappedStocks(collections.abc.MutableMapping):
+  # The stocks dict of a memory mapped snapshot. A stock is decoded into a
+  # Stock the first time it is accessed, stocks that are never touched cost
+  # only the pages of the map that are read.
+
+  def __init__(self, filename: str) -> None:
+    self._stocks = {}       # decoded or added stocks
+    self._deleted = set()   # snapshot ids removed from the dict
+    self.open(filename)
+
+  def open(self, filename: str):
+    self._snapshot = snapshot.open_mapped(filename)
+    self._deleted = set()
+
+  def close(self):
+    self._snapshot.close()
+    self._snapshot = None
+
+  def _row(self, stock_id) -> int:
+    if stock_id in self._deleted or not isinstance(stock_id, int):
+      return -1
+    return self._snapshot.find(stock_id)
+
+  def __getitem__(self, stock_id):
+    if stock_id in self._stocks:
+      return self._stocks[stock_id]
+
+    row = self._row(stock_id)
+    if row < 0:
+      raise KeyError(stock_id)
+
+    (info, scalars, series) = self._snapshot.record(row)
+    # copy the arrays so decoded stocks do not keep the map alive
+    series = dict((label, (periods.copy(), values.copy())) for label, (periods, values) in series.items())
+    stock = Stock('New').load_record((info, scalars, series))
+    self._stocks[stock_id] = stock
+    return stock
+
+  def __setitem__(self, stock_id, stock: Stock):
+    # a snapshot stock set again after it was deleted is back in the dict
+    self._deleted.discard(stock_id)
+    self._stocks[stock_id] = stock
+
+  def __delitem__(self, stock_id):
+    if stock_id in self._stocks:
+      del self._stocks[stock_id]
+      if self._row(stock_id) >= 0: self._deleted.add(stock_id)
+    elif self._row(stock_id) >= 0:
+      self._deleted.add(stock_id)
+    else:
+      raise KeyError(stock_id)
+
+  def __contains__(self, stock_id) -> bool:
+    return stock_id in self._stocks or self._row(stock_id) >= 0
+
+  def __iter__(self):
+    for stock_id in self._snapshot.ids.tolist():
+      if stock_id not in self._deleted: yield stock_id
+    for stock_id in self._stocks.keys():
+      if self._snapshot.find(stock_id) < 0: yield stock_id
+
+  def __len__(self) -> int:
+    return sum(1 for _ in self)
+
+  def get_record(self, stock_id):
+    # record of a stock without decoding it when it was not touched
+    if stock_id in self._stocks:
+      return self._stocks[stock_id].get_record()
+    return self._snapshot.record(self._row(stock_id))
+
+class DbStock(Stock):
+  # Stock loaded from a stock database. The setters record what they change
+  # and save() writes just those rows, so processes updating different
+  # fields of the same stock do not overwrite each other.
+
+  def __init__(self,
+               id: int,
+               database: stock_db.StockDatabase) -> None:
+    super().__init__(id)
+    self._database = database
+    self._changes = []
+
+  def set_info(self, key: str, value: str):
+    super().set_info(key, value)
+    self._changes.append(('info', key, value))
+    return self
+
+  def set_price(self, price: float):
+    super().set_price(price)
+    self._changes.append(('scalar', 'price', float(price)))
+    return self
+
+  def set_scalar(self, key: str, value: float):
+    super().set_scalar(key, value)
+    self._changes.append(('scalar', key, self._scalars.get(key)))
+    return self
+
+  def set_price_and_market_capital(self, price: float, market_capital: float):
+    super().set_price_and_market_capital(price, market_capital)
+    self._changes.append(('scalar', 'price', self._scalars['price']))
+    self._changes.append(('scalar', 'number_of_shares', self._scalars['number_of_shares']))
+    self._changes.append(('scalar', 'market_capital', None))
+    return self
+
+  def set_series_data(self, label: str, period: int, data: float):
+    super().set_series_data(label, period, data)
+    self._changes.append(('data', label, period, float(data)))
+
+  def save(self):
+    if self._changes:
+      self._database.apply(self.get_id(), self._changes)
+      self._changes = []
 
-  f = open(args.read_stock_data, "r", encoding='utf-8')
-  stocks_data = f.read().split("stock data:\n")
+class DbStocks(collections.abc.MutableMapping):
+  # The stocks dict of a stock database. Stocks are read when first accessed,
+  # stocks put into the dict are written right away.
 
-  for stock_data in stocks_data:
-    if stock_data:
-      stock = Stock('New').load_from_str(stock_data)
+  def __init__(self, filename: str) -> None:
+    self.filename = filename
+    self._database = stock_db.StockDatabase(filename)
+    self._stocks = {}
+
+  def __getitem__(self, stock_id):
+    if stock_id not in self._stocks:
+      record = self._database.read_record(stock_id)
+      if record is None:
+        raise KeyError(stock_id)
+      self._stocks[stock_id] = DbStock('New', self._database).load_record(record)
+    return self._stocks[stock_id]
+
+  def __setitem__(self, stock_id, stock: Stock):
+    record = stock.get_record()
+    self._database.write_record(stock_id, record)
+    self._stocks[stock_id] = DbStock('New', self._database).load_record(record)
+
+  def __delitem__(self, stock_id):
+    if not self._database.has_stock(stock_id):
+      raise KeyError(stock_id)
+    self._database.delete(stock_id)
+    self._stocks.pop(stock_id, None)
+
+  def __contains__(self, stock_id) -> bool:
+    return stock_id in self._stocks or self._database.has_stock(stock_id)
+
+  def __iter__(self):
+    return iter(self._database.get_ids())
+
+  def __len__(self) -> int:
+    return len(self._database.get_ids())
+
+  def get_database(self) -> stock_db.StockDatabase:
+    return self._database
+
+  def save(self):
+    for stock in self._stocks.values():
+      stock.save()
+
+  # journal interface, see open_journal
+
+  def append(self, stock: Stock):
+    if isinstance(stock, DbStock) and stock._database.filename == self.filename:
+      stock.save()
+    else:
+      self._database.write_record(stock.get_id(), stock.get_record())
+
+  def close(self):
+    self._database.close()
+
+def open_journal(filename: str):
+  # where scrub_all / scrub_one record each scraped stock: the journal next
+  # to a stock data file, or the database itself
+  if stock_db.is_database(filename):
+    return DbStocks(filename)
+  return StockJournal(filename)
+
+class StockJournal():
+  # Append-only log of stock updates kept next to a stock data file as
+  # <file>.journal. Every record is a whole stock in the text format followed
+  # by an end marker and is fsync'd, so a crash loses at most the stock that
+  # was being written. read_stock_data replays the journal on top of the file
+  # and write_stock_data folds it back in (see compact_stock_data).
+
+  suffix = ".journal"
+  end_marker = "end stock data\n"
+
+  def __init__(self, filename: str) -> None:
+    self.filename = StockJournal.path(filename)
+    self.f = None
+
+  @staticmethod
+  def path(filename: str) -> str:
+    return filename + StockJournal.suffix
+
+  def append(self, stock: Stock):
+    if self.f is None:
+      self.f = open(self.filename, "a", encoding='utf-8')
+    self.f.write("stock data:\n" + stock.as_str() + StockJournal.end_marker)
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+  @staticmethod
+  def replay(filename: str, stocks) -> int:
+    # applies the complete records of the journal of filename to stocks,
+    # a torn record at the end (crash while appending) is ignored
+    path = StockJournal.path(filename)
+    if not os.path.exists(path):
+      return 0
+
+    count = 0
+    lines = None
+    f = open(path, "r", encoding='utf-8')
+    for line_number, line in enumerate(f, 1):
+      if line == "stock data:\n":
+        lines = []
+      elif line == StockJournal.end_marker:
+        if lines is not None:
+          stock = load_stock_lines(lines, path)
+          stocks[stock.get_id()] = stock
+          count += 1
+        lines = None
+      elif lines is not None and line.strip():
+        lines.append((line_number, line))
+    f.close()
+    return count
+
+  @staticmethod
+  def remove(filename: str):
+    path = StockJournal.path(filename)
+    if os.path.exists(path):
+      os.remove(path)
+
+def read_stock_stream(f, filename: str = None):
+  # Yields the stocks of a text stock data file one at a time, holding only
+  # the lines of the current record in memory.
+  lines = []
+  for line_number, line in enumerate(f, 1):
+    if line == "stock data:\n":
+      if lines: yield load_stock_lines(lines, filename)
+      lines = []
+    elif line.strip():
+      lines.append((line_number, line))
+
+  if lines: yield load_stock_lines(lines, filename)
+
+def load_stock_lines(lines: [], filename: str = None) -> Stock:
+  try:
+    return Stock('New').load_from_lines(lines)
+  except StockDataError as error:
+    raise StockDataError(error.line_number, error.line, filename) from None
+
+def write_stock_stream(f, stocks):
+  # Writes stocks as they come from any iterable, e.g. read_stock_stream
+  for stock in stocks:
+    f.write("stock data:\n")
+    f.write(stock.as_str())
+
+def read_stock_data(filename: str = None):
+  # text or binary snapshot, picked by the file extension
+  if filename is None: filename = args.read_stock_data
+
+  stocks = {}
+
+  if snapshot.is_snapshot(filename):
+    stocks = MappedStocks(filename)
+  elif stock_db.is_database(filename):
+    return DbStocks(filename)
+  elif history.is_history(filename):
+    stocks = read_history(filename)
+  else:
+    f = open(filename, "r", encoding='utf-8')
+    for stock in read_stock_stream(f, filename):
       stocks[stock.get_id()] = stock
+    f.close()
 
-  f.close()
+  StockJournal.replay(filename, stocks)
 
   return stocks
 
-def write_stock_data(stocks):
-  f = open(args.write_stock_data, "w", encoding='utf-8')
-  for stock_id in sorted(stocks.keys()):
-    f.write("stock data:\n")
-    f.write(stocks[stock_id].as_str())
-  f.close()
+def write_stock_data(stocks, filename: str = None):
+  if filename is None: filename = args.write_stock_data
+
+  if snapshot.is_snapshot(filename):
+    if isinstance(stocks, MappedStocks):
+      records = [stocks.get_record(stock_id) for stock_id in sorted(stocks.keys())]
+      data = snapshot.encode(records, Stock.scalar_keys)
+      del records
+      # the destination may be the mapped file: unmap it while writing and
+      # map the new file, it holds every stock that was not decoded yet
+      stocks.close()
+      snapshot.write_bytes(filename, data)
+      stocks.open(filename)
+    else:
+      records = [stocks[stock_id].get_record() for stock_id in sorted(stocks.keys())]
+      snapshot.write(filename, records, Stock.scalar_keys)
+  elif stock_db.is_database(filename):
+    if isinstance(stocks, DbStocks) and stocks.filename == filename:
+      stocks.save()
+    else:
+      database = stock_db.StockDatabase(filename)
+      database.write_records([(stock_id, stocks[stock_id].get_record()) for stock_id in sorted(stocks.keys())], delete_others=True)
+      database.close()
+  elif history.is_history(filename):
+    commit_history(stocks, filename)
+  else:
+    # write next to the file and swap it in, a crash never leaves half a file
+    f = open(filename + ".tmp", "w", encoding='utf-8')
+    write_stock_stream(f, (stocks[stock_id] for stock_id in sorted(stocks.keys())))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(filename + ".tmp", filename)
+
+  # the file now holds every journaled update
+  StockJournal.remove(filename)
+
+def read_history(filename: str, version: int = None) -> {}:
+  # the stocks as of a version of a history file, the latest if None
+  stock_history = history.History(filename)
+  stocks = {}
+  for stock_id, fields in stock_history.checkout(version).items():
+    stocks[stock_id] = Stock(stock_id).load_fields(fields)
+  stock_history.close()
+  return stocks
+
+def commit_history(stocks, filename: str, note: str = "") -> int:
+  # stores the values that changed since the last version as a new version
+  stock_history = history.History(filename)
+  version = stock_history.commit(dict((stock_id, stocks[stock_id].get_fields()) for stock_id in stocks.keys()), note)
+  stock_history.close()
+  return version
+
+def compact_stock_data(filename: str):
+  # fold the journal of filename back into the file
+  write_stock_data(read_stock_data(filename), filename)
+
+def convert_stock_data(source: str, destination: str):
+  write_stock_data(read_stock_data(source), destination)
+
+# the graphs of the stock list (figures_url in the sphinx sources), and the
+# files their series were drawn to
+figures_directory = 'source/_static/png'
+figures_url = '_static/png'
+graph_cache_file = 'source/graph_cache.json'
+graph_batch_size = 256  # most graphs a render_graphs process draws per task
+
+def render_graph_batch(batch: []) -> []:
+  # (key, graph file name, png) of every (key, series) job of the batch, runs
+  # in the processes of render_graphs
+  rv = []
+  for (key, data) in batch:
+    pixels = Stock.bar_graph_pixels(data)
+    rv.append((key, graph_cache.content_name(pixels), Stock.bar_graph_png(pixels)))
+  return rv
+
+def render_graphs(stocks: [], cache, jobs: int = 1) -> {}:
+  # Stock id -> graph name -> file of the graph in the graph_cache.GraphCache.
+  # Only the series the cache does not know are drawn, each once, in batches
+  # over jobs processes; this process writes the files of every batch it
+  # gets back, unless another series already drew the same graph.
+  keys = {}
+  pending = {}
+  for stock in stocks:
+    keys[stock.get_id()] = {}
+    for name, data in stock.get_graphs().items():
+      key = graph_cache.graph_key(data, Stock.bar_graph_parameters)
+      keys[stock.get_id()][name] = key
+      if cache.get(key) is None:
+        pending[key] = [float(value) for value in data]
+
+  # 0 (or less) is a process per cpu
+  if jobs < 1:
+    jobs = os.cpu_count() or 1
+  jobs = min(jobs, len(pending) // graph_batch_size + 1)
+  batch_size = max(1, min(graph_batch_size, len(pending) // (4 * jobs)))
+  pending = list(pending.items())
+  batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+  def write(results):
+    for (key, name, data) in results:
+      if not os.path.exists(cache.path(name)):
+        f = open(cache.path(name), "wb")
+        f.write(data)
+        f.close()
+        cache.drawn += 1
+      cache.put(key, name)
+
+  if jobs > 1:
+    with multiprocessing.Pool(jobs) as pool:
+      for results in pool.imap_unordered(render_graph_batch, batches):
+        write(results)
+  else:
+    for batch in batches:
+      write(render_graph_batch(batch))
+
+  images = {}
+  for stock_id, stock_keys in keys.items():
+    images[stock_id] = dict((name, cache.files[key]) for name, key in stock_keys.items())
+    for image in images[stock_id].values():
+      cache.refer(image)
+  return images
+
+def get_graph_markup(stock: Stock, graphs: str, images: {}) -> {}:
+  # graph name -> rst showing the graph: an image of its file in images, as
+  # render_graphs returns them (png), or the graph inlined as svg, no request
+  # per graph (svg)
+  if graphs == "svg":
+    return dict((name, ".. raw:: html\n\n   " + Stock.bar_graph_svg(data)) for name, data in stock.get_graphs().items())
+  return dict((name, ".. image:: %s/%s" % (figures_url, image)) for name, image in images.items())
+
+def write_sphinx(stocks: [], graphs: str = "png", jobs: int = 1):
+  # The rows of the stock list and the graphs they show. Graphs whose series
+  # did not change are not drawn again, stocks with the same graph share its
+  # file and files no stock shows any more are deleted (all of them with svg
+  # graphs). The png graphs are drawn first, on jobs processes.
+  cache = graph_cache.GraphCache(graph_cache_file, figures_directory)
+  sorted_stocks = Universe(stocks).get_sorted_stocks()
+  images = render_graphs(sorted_stocks, cache, jobs) if graphs == "png" else {}
 
-def write_sphinx(stocks: []):
   f = open("source/stock_list.txt", "w", encoding='utf-8')
 
   f.write(".. list-table:: \n")
@@ -710,31 +2278,70 @@ def write_sphinx(stocks: []):
   # f.write("  :widths: 3 1 1 1 1 1 1 1 1 10 1 3 1 2 1 3 1\n")
   f.write("\n")
   f.write(Stock.get_stock_list_header())
-  for stock in sorted(stocks.values(), key=Stock.sort, reverse=1):
-    f.write(stock.get_stock_list_row())
+  for stock in sorted_stocks:
+    f.write(stock.get_stock_list_row(get_graph_markup(stock, graphs, images.get(stock.get_id()))))
 
   f.close()
 
-# https://www.bizportal.co.il/tradedata/paperslist
-if __name__ == "__main__":
-  # sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-  # sys.stderr = codecs.getwriter('utf8')(sys.stderr)
-  sys.stdout.flush()
+  cache.collect()
+  cache.save()
+  print(cache.summary())
 
+def make_parser():
   parser = argparse.ArgumentParser(description='Stock scrubber')
-  parser.add_argument("--read_stock_data", default="stock_data.txt", type=str, help="Reads stock data from file.")
+  parser.add_argument("--read_stock_data", default="stock_data.txt", type=str, help="Reads stock data from file (%s files are binary snapshots, %s files SQLite databases, %s files the latest version of a history)." % (snapshot.extension, "/".join(stock_db.extensions), history.extension))
+  parser.add_argument("--as_of", default=None, type=int, help="Reads the stock data as of this version of the %s file given by --read_stock_data." % history.extension)
   parser.add_argument("--init_stock_data", default=None, type=str, help="Init stock data file from CSV list.")
   parser.add_argument("--scrub_prices", default=False, help="Goes over all stocks and reads prices.")
   parser.add_argument("--scrub_all", default=False, help="Goes over all stocks and reads all data.")
+  parser.add_argument("--prices_file", default=None, type=str, help="With --scrub_prices, read the prices from this CSV file (stock_id,price columns or the TASE end of day export) instead of the TASE site.")
   parser.add_argument("--scrub_one", default=0, type=int, help="Scrube one stock.")
-  parser.add_argument("--scrub_start", default=0, type=int, help="Goes over all stocks and reads all data.")
+  parser.add_argument("--scrub_budget", default=0, type=float, help="Minutes --scrub_all may take, the most important stocks are scraped first.")
+  parser.add_argument("--run_dir", default="scrape_runs", type=str, help="Directory of the --scrub_all run checkpoints.")
+  parser.add_argument("--resume", default=None, nargs="?", const="latest", type=str, help="Continue a --scrub_all run that stopped, the latest by default or the given run id.")
+  parser.add_argument("--scrub_retries", default=2, type=int, help="Times --scrub_all tries a failed stock again after all others.")
+  parser.add_argument("--watchlist", default=None, type=str, help="File of stock ids (one per line) --scrub_all refreshes before others.")
+  parser.add_argument("--scrub_workers", default=1, type=int, help="Number of browser processes --scrub_all runs in parallel.")
+  parser.add_argument("--fetcher", default="selenium", choices=("selenium", "http", "replay"), help="Scrape stock pages with a browser (selenium), fetch and parse them directly (http, needs aiohttp and lxml) or parse them from the --page_cache without fetching (replay).")
+  parser.add_argument("--page_cache", default=None, type=str, help="Keep scraped pages in this cache file and reuse those that are still fresh.")
+  parser.add_argument("--base_url", default="https://www.bizportal.co.il", type=str, help="Site the http fetcher reads the stock pages from.")
+  parser.add_argument("--http_connections", default=8, type=int, help="Number of connections the http fetcher keeps open.")
+  parser.add_argument("--incremental", default=0, type=int, help="Read the reports of a stock only once a new quarter may have been reported, and its other pages only if they changed.")
+  parser.add_argument("--full_scrape_days", default=30, type=int, help="With --incremental, scrape every stock in full after this many days.")
+  parser.add_argument("--rate_limit", default=5, type=float, help="Most requests per second the scrapers send to one host, they adapt below it.")
+  parser.add_argument("--max_in_flight", default=8, type=int, help="Most requests the scrapers have open to one host at a time.")
+  parser.add_argument("--limiter_stats", default=None, type=str, help="Write the request rate, latency percentiles and limits per host to this json file after scraping.")
+  parser.add_argument("--wait_timeout", default=30, type=float, help="Seconds to wait for a scraped page to be ready.")
   parser.add_argument("--write_sphinx", default=1, type=int, help="Generate sphinx data.")
-  parser.add_argument("--write_stock_data", default=None, type=str, help="After all processing write stock data to file.")
-  args = parser.parse_args()
+  parser.add_argument("--jobs", default=1, type=int, help="Number of processes drawing the png graphs of the stock list, 1 draws them in this process and 0 uses one process per cpu.")
+  parser.add_argument("--sphinx_graphs", default="png", choices=("png", "svg"), help="Show the graphs of the stock list as shared png files (png) or inline them into the page as svg (svg).")
+  parser.add_argument("--write_stock_data", default=None, type=str, help="After all processing write stock data to file (%s files are binary snapshots, %s files SQLite databases, %s files commit a history version)." % (snapshot.extension, "/".join(stock_db.extensions), history.extension))
+  parser.add_argument("--commit_history", default=None, type=str, help="After all processing commit the stock data as a new version of this %s file." % history.extension)
+  parser.add_argument("--compact_stock_data", default=None, type=str, help="Fold the journal of a stock data file back into the file and exit.")
+  parser.add_argument("--convert_stock_data", default=None, nargs=2, type=str, metavar=("SOURCE", "DESTINATION"), help="Convert stock data between the text, binary snapshot, SQLite and history formats and exit.")
+  return parser
+
+# https://www.bizportal.co.il/tradedata/paperslist
+if __name__ == "__main__":
+  # sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+  # sys.stderr = codecs.getwriter('utf8')(sys.stderr)
+  sys.stdout.flush()
+
+  args = make_parser().parse_args()
+
+  if args.convert_stock_data:
+    convert_stock_data(*args.convert_stock_data)
+    sys.exit(0)
+
+  if args.compact_stock_data:
+    compact_stock_data(args.compact_stock_data)
+    sys.exit(0)
 
   stocks = {}
 
-  if args.read_stock_data:
+  if args.read_stock_data and args.as_of is not None:
+    stocks = read_history(args.read_stock_data, args.as_of)
+  elif args.read_stock_data:
     stocks = read_stock_data()
 
   if args.init_stock_data:
@@ -751,14 +2358,17 @@ if __name__ == "__main__":
   if args.scrub_one:
     scrub_one(stocks, args.scrub_one)
 
-  if args.scrub_all:
-    scrub_all(stocks, args.scrub_start)
+  if args.scrub_all or args.resume:
+    scrub_all(stocks)
 
   if args.write_stock_data:
     write_stock_data(stocks)
 
+  if args.commit_history:
+    commit_history(stocks, args.commit_history, " ".join(sys.argv[1:]))
+
   if args.write_sphinx:
-    write_sphinx(stocks)
+    write_sphinx(stocks, args.sphinx_graphs, args.jobs)
 
   '''
 Price to earnings ratio < 15
@@ -0,0 +1,110 @@
+import os
+import re
+import sys
+import json
+import hashlib
+
+# Cache of the drawn graph files.
+#
+# A graph file is stored once per content: it is named by the hash of its
+# pixels, and every stock whose graph looks the same (all zero dividends,
+# missing years) refers to the one file. The cache maps the key of a series, a
+# hash of it and of the drawing parameters, to the file it was drawn to, so a
+# series seen before is not drawn again and a run where only prices changed
+# writes no image at all. The graph files no stock refers to any more are
+# removed. The keys are kept in a json file next to the sphinx sources.
+#
+#   python graph_cache.py source/graph_cache.json       lists the cached graphs
+
+# the graph files of the cache's directory, graph_<content hash>.png, and
+# the <graph>_<stock id>.png files they replace
+graph_file = re.compile(r"^\w+\.png$")
+
+def graph_key(data: [], parameters: ()) -> str:
+  return hashlib.sha1(repr(([float(value) for value in data], parameters)).encode("utf-8")).hexdigest()
+
+def content_name(pixels) -> str:
+  # file name of a graph by the hash of its pixels, a numpy array
+  return "graph_%s.png" % hashlib.sha1(repr(pixels.shape).encode("utf-8") + pixels.tobytes()).hexdigest()[:16]
+
+class GraphCache():
+
+  def __init__(self, filename: str, directory: str) -> None:
+    self.filename = filename
+    self.directory = directory
+    self.files = {}       # series key -> graph file name
+    if os.path.exists(filename):
+      f = open(filename, "r", encoding='utf-8')
+      self.files = json.load(f)
+      f.close()
+    self.changed = False
+    self.references = {}  # graph file name -> references of this run
+    self.drawn = 0
+    self.removed = 0
+
+  def path(self, name: str) -> str:
+    return "%s/%s" % (self.directory, name)
+
+  def get(self, key: str) -> str:
+    # the graph file of the series key, None if not drawn or since removed
+    name = self.files.get(key)
+    if name is None or not os.path.exists(self.path(name)):
+      return None
+    return name
+
+  def put(self, key: str, name: str):
+    if self.files.get(key) != name:
+      self.files[key] = name
+      self.changed = True
+
+  def refer(self, name: str):
+    self.references[name] = self.references.get(name, 0) + 1
+
+  def collect(self):
+    # removes the graph files that were not referred to by this run
+    for name in os.listdir(self.directory):
+      if graph_file.match(name) is None or name in self.references:
+        continue
+      os.remove(self.path(name))
+      self.removed += 1
+
+    for key in [key for key, name in self.files.items() if name not in self.references]:
+      del self.files[key]
+      self.changed = True
+
+  def save(self):
+    # the json file is only written if the keys changed
+    if not self.changed:
+      return
+    f = open(self.filename, "w", encoding='utf-8')
+    json.dump(self.files, f, indent=0, sort_keys=True)
+    f.close()
+    self.changed = False
+
+  def get_dedup_stats(self) -> {}:
+    # references and files of this run, their size on disk and the size the
+    # files would have as one file per reference
+    references = sum(self.references.values())
+    sizes = dict((name, os.path.getsize(self.path(name))) for name in self.references.keys())
+    return {
+      'references': references,
+      'files': len(self.references),
+      'ratio': references / len(self.references) if self.references else 0,
+      'bytes': sum(sizes.values()),
+      'bytes_per_reference': sum(sizes[name] * count for name, count in self.references.items()),
+    }
+
+  def summary(self) -> str:
+    stats = self.get_dedup_stats()
+    return "graphs: %d references to %d files (%.1fx), %d KB instead of %d KB, %d drawn, %d removed" % (
+      stats['references'], stats['files'], stats['ratio'], stats['bytes'] // 1024, stats['bytes_per_reference'] // 1024,
+      self.drawn, self.removed)
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print("usage: python graph_cache.py <graph cache>")
+    sys.exit(1)
+
+  cache = GraphCache(sys.argv[1], "")
+  for key, name in sorted(cache.files.items(), key=lambda item: item[1]):
+    print("%s  %s" % (name, key))
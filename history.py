@@ -0,0 +1,146 @@
+import sys
+import time
+import sqlite3
+
+# Versioned history of the stock data.
+#
+# Every commit stores a new version with only the (stock, key) values that
+# differ from the previous version, so a daily commit costs the handful of
+# values a scrape changed instead of a full copy of the file. A value of NULL
+# marks a key (or a whole stock) that was removed. The universe as of any
+# version is the latest change of every (stock, key) up to that version, one
+# query over the primary key. Keys ("A dividend 2019", "price") are stored
+# once in the keys table and referenced by id.
+#
+# Stocks are handled as flat key -> string dicts, the same keys and values
+# as in the stock data text file (Stock.get_fields).
+#
+#   python history.py stock_data.history                 lists the versions
+#   python history.py stock_data.history OLD NEW         changes between two versions
+
+extension = ".history"
+
+schema = """
+CREATE TABLE IF NOT EXISTS versions (
+  version INTEGER PRIMARY KEY,
+  created TEXT NOT NULL,
+  note    TEXT NOT NULL,
+  changes INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS keys (
+  key_id  INTEGER PRIMARY KEY,
+  key     TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+  stock_id INTEGER NOT NULL,
+  key_id   INTEGER NOT NULL,
+  version  INTEGER NOT NULL,
+  value    TEXT,
+  PRIMARY KEY (stock_id, key_id, version)
+) WITHOUT ROWID;
+"""
+
+def is_history(filename: str) -> bool:
+  return filename.endswith(extension)
+
+class History():
+
+  def __init__(self, filename: str) -> None:
+    self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.executescript(schema)
+
+  def close(self):
+    self.connection.close()
+
+  def get_versions(self) -> []:
+    # (version, created, note, number of changed values)
+    return self.connection.execute("SELECT version, created, note, changes FROM versions ORDER BY version").fetchall()
+
+  def get_latest_version(self) -> int:
+    return self.connection.execute("SELECT coalesce(max(version), 0) FROM versions").fetchone()[0]
+
+  def checkout(self, version: int = None) -> {}:
+    # stock id -> {key: value} as of the version, the latest if None
+    if version is None:
+      version = self.get_latest_version()
+
+    keys = dict(self.connection.execute("SELECT key_id, key FROM keys"))
+
+    # SQLite returns the other columns from the row holding max(version)
+    rows = self.connection.execute(
+      "SELECT stock_id, key_id, value, max(version) FROM changes WHERE version <= ? GROUP BY stock_id, key_id",
+      (version,))
+
+    stocks = {}
+    for (stock_id, key_id, value, _) in rows:
+      if value is not None:
+        stocks.setdefault(stock_id, {})[keys[key_id]] = value
+    return stocks
+
+  def key_ids(self, keys) -> {}:
+    # key -> key id, adding the keys not seen before
+    self.connection.executemany("INSERT OR IGNORE INTO keys (key) VALUES (?)", [(key,) for key in keys])
+    return dict((key, key_id) for (key_id, key) in self.connection.execute("SELECT key_id, key FROM keys"))
+
+  def commit(self, stocks: {}, note: str = "") -> int:
+    # stocks is stock id -> {key: value}; returns the new version
+    self.connection.execute("BEGIN IMMEDIATE")
+    try:
+      previous = self.checkout()
+      changes = []
+
+      for stock_id, fields in stocks.items():
+        old = previous.get(stock_id, {})
+        for key, value in fields.items():
+          if old.get(key) != value:
+            changes.append((stock_id, key, value))
+        for key in old.keys() - fields.keys():
+          changes.append((stock_id, key, None))
+
+      for stock_id in previous.keys() - stocks.keys():
+        for key in previous[stock_id].keys():
+          changes.append((stock_id, key, None))
+
+      version = self.get_latest_version() + 1
+      key_ids = self.key_ids(set(key for (_, key, _) in changes))
+      self.connection.execute("INSERT INTO versions VALUES (?, ?, ?, ?)",
+                              (version, time.strftime("%Y-%m-%d %H:%M:%S"), note, len(changes)))
+      self.connection.executemany("INSERT INTO changes VALUES (?, ?, ?, ?)",
+                                  [(stock_id, key_ids[key], version, value) for (stock_id, key, value) in changes])
+      self.connection.execute("COMMIT")
+    except:
+      self.connection.execute("ROLLBACK")
+      raise
+
+    return version
+
+  def diff(self, old: int, new: int) -> []:
+    # (stock id, key, old value, new value) of every value that differs
+    before = self.checkout(old)
+    after = self.checkout(new)
+
+    rv = []
+    for stock_id in sorted(before.keys() | after.keys()):
+      old_fields = before.get(stock_id, {})
+      new_fields = after.get(stock_id, {})
+      for key in sorted(old_fields.keys() | new_fields.keys()):
+        if old_fields.get(key) != new_fields.get(key):
+          rv.append((stock_id, key, old_fields.get(key), new_fields.get(key)))
+    return rv
+
+if __name__ == "__main__":
+  if len(sys.argv) not in (2, 4):
+    print("usage: python history.py <history> [<old version> <new version>]")
+    sys.exit(1)
+
+  history = History(sys.argv[1])
+  if len(sys.argv) == 2:
+    for (version, created, note, changes) in history.get_versions():
+      print("%4d  %s  %7d changes  %s" % (version, created, changes, note))
+  else:
+    for (stock_id, key, old, new) in history.diff(int(sys.argv[2]), int(sys.argv[3])):
+      print("%d  %s: %s -> %s" % (stock_id, key, old, new))
+  history.close()
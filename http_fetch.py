@@ -0,0 +1,191 @@
+import re
+import json
+import time
+import asyncio
+import urllib.parse
+import lxml.html
+import rate_limit
+
+# Browserless fetch of the bizportal quote pages.
+#
+# The reports, performance and general view pages of many stocks are fetched
+# concurrently over a pool of keep-alive connections and parsed with lxml, so
+# the xpaths used with Selenium work on them as well. The annual reports are
+# not in the reports page: its annual tab loads them from the site, so the url
+# the tab loads is read from the reports page and fetched next, as the browser
+# does on the click. Nothing here knows what the tables mean: a stock's pages
+# are handed back as parsed documents. With a page_cache.PageCache, fresh
+# cached pages are not fetched again, and fetched pages are cached once the
+# caller loaded them, so a broken page is fetched again on the next try.
+# aiohttp is only imported to fetch: reading cached pages needs just lxml.
+#
+#   python http_fetch.py 1082379            fetches one stock, prints its tables
+
+base_url = "https://www.bizportal.co.il"
+
+pages = {
+  'reports':        "/capitalmarket/quote/reports/%d",
+  'performance':    "/capitalmarket/quote/performance/%d",
+  'general_view':   "/capitalmarket/quote/generalview/%d",
+  # the content of a tab of another page: (page, tab id)
+  'reports annual': ('reports', "profit-and-loss-report-tabstrip-2"),
+}
+
+def is_tab(name: str) -> bool:
+  return isinstance(pages[name], tuple)
+
+def tab_url(document, url: str, tab: str) -> str:
+  # the url the kendo tab strip of the page at url loads the content of tab
+  # from, None if the content is in the page or there is no such tab. The url
+  # is in the tab's data-content-url or in the contentUrls of the script that
+  # sets up the tab strip.
+  if document.xpath("//div[@id='%s']//table" % tab):
+    return None
+  for item in document.xpath("//li[@aria-controls='%s']" % tab):
+    for element in [item] + item.xpath(".//*[@data-content-url]"):
+      if element.get("data-content-url"):
+        return urllib.parse.urljoin(url, element.get("data-content-url"))
+
+  (strip, index) = tab.rsplit("-", 1)
+  for script in document.iter("script"):
+    if script.text is None or strip not in script.text: continue
+    m = re.search(r'"contentUrls"\s*:\s*(\[[^\]]*\])', script.text[script.text.index(strip):])
+    if m is None: continue
+    try:
+      urls = json.loads(m.group(1))
+    except ValueError:
+      continue
+    if int(index) <= len(urls) and urls[int(index) - 1]:
+      return urllib.parse.urljoin(url, urls[int(index) - 1])
+  return None
+
+def parse(html: str):
+  document = lxml.html.fromstring(html)
+  # browsers put the rows of a table without one into a tbody, the xpaths
+  # rely on it
+  for table in document.iter("table"):
+    rows = [child for child in table if child.tag == "tr"]
+    if rows:
+      tbody = lxml.html.Element("tbody")
+      rows[0].addprevious(tbody)
+      tbody.extend(rows)
+  return document
+
+async def fetch_page(session, url: str, cache = None, limiter = None, fetched: [] = None):
+  # a page not in the cache is added to fetched as (url, html)
+  html = cache.get(url) if cache is not None else None
+  if html is None:
+    async with rate_limit.Limited(limiter, url):
+      async with session.get(url) as response:
+        response.raise_for_status()
+        html = await response.text()
+    if fetched is not None:
+      fetched.append((url, html))
+  return parse(html)
+
+async def fetch_stock(session, base: str, stock_id: int, cache = None, names: [] = None, limiter = None, fetched: [] = None) -> {}:
+  # page name -> parsed document, the pages (all by default) are fetched at
+  # the same time and then the tabs of those that load their content
+  if names is None: names = list(pages.keys())
+  page_names = [name for name in names if not is_tab(name)]
+  documents = dict(zip(page_names, await asyncio.gather(*[fetch_page(session, base + pages[name] % stock_id, cache, limiter, fetched) for name in page_names])))
+
+  tabs = []
+  for name in names:
+    if not is_tab(name) or pages[name][0] not in documents: continue
+    (page, tab) = pages[name]
+    url = tab_url(documents[page], base + pages[page] % stock_id, tab)
+    if url is not None:
+      tabs.append((name, url))
+  for (name, document) in zip([name for (name, _) in tabs], await asyncio.gather(*[fetch_page(session, url, cache, limiter, fetched) for (_, url) in tabs])):
+    documents[name] = document
+  return documents
+
+async def fetch_stocks(stock_ids: [], handle, base: str = base_url, connections: int = 8, timeout: float = 30, cache = None, page_names: {} = {}, deadline: float = None, limiter = None):
+  # handle(stock id, pages, error) is called as each stock is fetched, pages
+  # is None if fetching failed; it returns whether the pages loaded, only
+  # then are the fetched pages cached. page_names limits the pages of some
+  # stocks.
+  # Stocks are started in order, as many at a time as there are connections,
+  # and none after the deadline (time.time()). Requests wait for the
+  # rate_limit.RateLimiter, a default one if None.
+  import aiohttp
+
+  if limiter is None: limiter = rate_limit.RateLimiter()
+  connector = aiohttp.TCPConnector(limit=connections)
+  started = asyncio.Semaphore(connections)
+  async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+
+    async def fetch(stock_id):
+      async with started:
+        if deadline is not None and time.time() > deadline:
+          return
+        fetched = []
+        try:
+          documents = await fetch_stock(session, base, stock_id, cache, page_names.get(stock_id), limiter, fetched)
+        except Exception as error:
+          handle(stock_id, None, error)
+          return
+      if handle(stock_id, documents, None) and cache is not None:
+        for (url, html) in fetched:
+          cache.put(url, html)
+
+    await asyncio.gather(*[fetch(stock_id) for stock_id in stock_ids])
+
+def fetch_all(stock_ids: [], handle, base: str = base_url, connections: int = 8, timeout: float = 30, cache = None, page_names: {} = {}, deadline: float = None, limiter = None):
+  asyncio.run(fetch_stocks(stock_ids, handle, base, connections, timeout, cache, page_names, deadline, limiter))
+
+def cached_stock(cache, base: str, stock_id: int, fresh: bool = True) -> {}:
+  # page name -> parsed document from the cache alone, None unless every page
+  # is cached. A tab is cached by the url it loads, or by the browser as its
+  # page with the tab shown, in the state named after the tab ('annual').
+  documents = {}
+  for name in [name for name in pages.keys() if not is_tab(name)]:
+    html = cache.get(base + pages[name] % stock_id, "", fresh)
+    if html is None:
+      return None
+    documents[name] = parse(html)
+
+  for name in [name for name in pages.keys() if is_tab(name)]:
+    (page, tab) = pages[name]
+    url = tab_url(documents[page], base + pages[page] % stock_id, tab)
+    html = cache.get(url, "", fresh) if url is not None else None
+    if html is None:
+      html = cache.get(base + pages[page] % stock_id, name[len(page) + 1:], fresh)
+    if html is not None:
+      documents[name] = parse(html)
+  return documents
+
+def text(element) -> str:
+  # whitespace collapsed, as a browser shows it
+  return " ".join(element.text_content().split())
+
+def table_cells(table) -> []:
+  # the th cells of the heading row and the td cells of every other row
+  rows = list(table.iter("tr"))
+  if not rows:
+    return []
+  cells = [[text(cell) for cell in rows[0].iter("th")]]
+  for row in rows[1:]:
+    cells.append([text(cell) for cell in row.iter("td")])
+  return cells
+
+def body_cells(tbody) -> []:
+  # the td cells of every row
+  return [[text(cell) for cell in row.iter("td")] for row in tbody.iter("tr")]
+
+if __name__ == "__main__":
+  import sys
+
+  def show(stock_id, documents, error):
+    if error is not None:
+      print("%d: %s" % (stock_id, error))
+      return
+    for name, document in documents.items():
+      for table in document.iter("table"):
+        print("%d %s %s" % (stock_id, name, table.get("id", "")))
+        for row in table_cells(table):
+          print("  " + " | ".join(row))
+    return True
+
+  fetch_all([int(stock_id) for stock_id in sys.argv[1:]], show)
@@ -0,0 +1,84 @@
+import sys
+import time
+import zlib
+import sqlite3
+
+# On-disk cache of scraped pages.
+#
+# Pages are stored compressed in a SQLite file, keyed by URL and the state of
+# the page when it was read ("" as loaded, "annual" after clicking the annual
+# reports tab), with the time they were fetched. A page is fresh for the TTL
+# of its page type: reports change once a quarter, prices by the minute.
+# Replaying from the cache ignores the TTL.
+#
+#   python page_cache.py pages.cache        lists the cached pages
+
+schema = """
+CREATE TABLE IF NOT EXISTS pages (
+  url     TEXT NOT NULL,
+  state   TEXT NOT NULL,
+  fetched REAL NOT NULL,
+  html    BLOB NOT NULL,
+  PRIMARY KEY (url, state)
+) WITHOUT ROWID;
+"""
+
+# page type -> seconds a cached page is fresh
+ttls = {
+  'reports':      3 * 24 * 3600,
+  'performance':  24 * 3600,
+  'generalview':  10 * 60,
+  'MarketData':   10 * 60,
+}
+default_ttl = 3600
+
+def page_type(url: str) -> str:
+  # reports, performance, generalview for the bizportal quote pages
+  for name in ttls.keys():
+    if "/%s" % name in url:
+      return name
+  return ""
+
+def get_ttl(url: str) -> float:
+  return ttls.get(page_type(url), default_ttl)
+
+class PageCache():
+
+  def __init__(self, filename: str) -> None:
+    self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.executescript(schema)
+    self.hits = 0
+    self.misses = 0
+
+  def close(self):
+    self.connection.close()
+
+  def get(self, url: str, state: str = "", fresh: bool = True) -> str:
+    # the cached html, None if not cached or (with fresh) older than the TTL
+    row = self.connection.execute("SELECT fetched, html FROM pages WHERE url = ? AND state = ?", (url, state)).fetchone()
+    if row is None or (fresh and time.time() - row[0] > get_ttl(url)):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return zlib.decompress(row[1]).decode("utf-8")
+
+  def put(self, url: str, html: str, state: str = ""):
+    self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                            (url, state, time.time(), zlib.compress(html.encode("utf-8"))))
+
+  def get_pages(self) -> []:
+    # (url, state, fetched, compressed size) of every cached page
+    return self.connection.execute("SELECT url, state, fetched, length(html) FROM pages ORDER BY url, state").fetchall()
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print("usage: python page_cache.py <cache>")
+    sys.exit(1)
+
+  cache = PageCache(sys.argv[1])
+  now = time.time()
+  for (url, state, fetched, size) in cache.get_pages():
+    age = now - fetched
+    print("%s%s  %7d bytes  %8.0fs old%s" % (url, " [%s]" % state if state else "", size, age, "" if age <= get_ttl(url) else "  stale"))
+  cache.close()
@@ -0,0 +1,184 @@
+import time
+import asyncio
+import threading
+import collections
+import urllib.parse
+import multiprocessing.managers
+
+# Per host rate limiting for the scrapers.
+#
+# Every request to a host first takes a token of the host's bucket and a slot
+# of its in-flight limit, and reports its latency and outcome when done. The
+# rate and the in-flight limit adapt: a failed request halves both, slow
+# responses (median of the recent ones above twice the best median seen) cut
+# them by a fifth, and healthy responses raise them a step at a time, up to the
+# configured maximum.
+#
+# The browser workers of a parallel scrape run in other processes, they share
+# one RateLimiter through a SharedLimiter manager, which serves every worker
+# on a thread of its own: the limiter takes a lock. Callers do not block inside
+# the limiter: acquire returns how long to wait and the caller sleeps.
+
+window = 50              # recent requests the latency and errors are judged on
+adapt_interval = 1.0     # seconds between two decreases
+latency_samples = 10000  # latest latencies the percentiles are taken of
+rate_span = 60           # seconds the observed rate is taken over
+
+class HostLimit():
+
+  def __init__(self, max_rate: float, max_in_flight: int) -> None:
+    self.max_rate = max_rate
+    self.max_in_flight = max_in_flight
+    self.rate = max(max_rate / 2, 0.1)
+    self.in_flight_limit = max(max_in_flight // 4, 1)
+    self.tokens = 1.0
+    self.in_flight = 0
+    self.updated = time.time()
+    self.decreased = 0.0
+    self.healthy = 0      # healthy responses since the in-flight limit grew
+    self.best_median = None
+    self.recent = []      # (latency, ok) of the last requests
+    self.latencies = collections.deque(maxlen=latency_samples)  # latest latencies, for the percentiles
+    self.started = collections.deque()  # start times of the last rate_span seconds, for the observed rate
+    self.first = None     # start time of the first request
+    self.requests = 0
+    self.errors = 0
+
+  def acquire(self, now: float) -> float:
+    # 0 when the request may start, else the seconds to wait
+    self.tokens = min(self.tokens + (now - self.updated) * self.rate, max(self.rate, 1.0))
+    self.updated = now
+    if self.in_flight >= self.in_flight_limit:
+      return 0.05
+    if self.tokens < 1:
+      return (1 - self.tokens) / self.rate
+    self.tokens -= 1
+    self.in_flight += 1
+    if self.first is None: self.first = now
+    self.started.append(now)
+    while self.started[0] <= now - rate_span:
+      self.started.popleft()
+    return 0
+
+  def release(self, latency: float, ok: bool, now: float):
+    self.in_flight -= 1
+    self.requests += 1
+    self.latencies.append(latency)
+    self.recent = (self.recent + [(latency, ok)])[-window:]
+    if not ok:
+      self.errors += 1
+
+    last = sorted(latency for (latency, _) in self.recent[-10:])
+    median = last[len(last) // 2]
+    if len(last) == 10 and (self.best_median is None or median < self.best_median):
+      self.best_median = median
+
+    if not ok:
+      self.decrease(0.5, now)
+    elif self.best_median is not None and median > 2 * self.best_median:
+      self.decrease(0.8, now)
+    else:
+      self.rate = min(self.rate + 0.1, self.max_rate)
+      self.healthy += 1
+      if self.healthy >= self.in_flight_limit:
+        self.in_flight_limit = min(self.in_flight_limit + 1, self.max_in_flight)
+        self.healthy = 0
+
+  def decrease(self, factor: float, now: float):
+    # once per adapt_interval, one slow burst is one signal
+    if now - self.decreased < adapt_interval:
+      return
+    self.decreased = now
+    self.healthy = 0
+    self.rate = max(self.rate * factor, 0.1)
+    self.in_flight_limit = max(int(self.in_flight_limit * factor), 1)
+
+  def requests_per_second(self, now: float) -> float:
+    # over the last rate_span seconds, or since the first request if that is
+    # sooner
+    if self.first is None:
+      return 0
+    span = max(min(rate_span, now - self.first), 0.001)
+    return len([start for start in self.started if start > now - span]) / span
+
+  def get_stats(self, now: float) -> {}:
+    latencies = sorted(self.latencies)
+    def percentile(p):
+      return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] if latencies else 0
+    return {
+      'requests': self.requests,
+      'errors': self.errors,
+      'requests_per_second': self.requests_per_second(now),
+      'latency_p50': percentile(50),
+      'latency_p90': percentile(90),
+      'latency_p99': percentile(99),
+      'rate': self.rate,
+      'in_flight_limit': self.in_flight_limit,
+    }
+
+class RateLimiter():
+
+  def __init__(self, max_rate: float = 5, max_in_flight: int = 8) -> None:
+    self.max_rate = max_rate
+    self.max_in_flight = max_in_flight
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def host(self, name: str) -> HostLimit:
+    if name not in self.hosts:
+      self.hosts[name] = HostLimit(self.max_rate, self.max_in_flight)
+    return self.hosts[name]
+
+  def acquire(self, host: str) -> float:
+    with self.lock:
+      return self.host(host).acquire(time.time())
+
+  def release(self, host: str, latency: float, ok: bool):
+    with self.lock:
+      self.host(host).release(latency, ok, time.time())
+
+  def get_stats(self) -> {}:
+    # host -> observed rate, latency percentiles and the current limits
+    with self.lock:
+      now = time.time()
+      return dict((name, host.get_stats(now)) for name, host in self.hosts.items())
+
+class SharedLimiter(multiprocessing.managers.BaseManager):
+  pass
+
+SharedLimiter.register("RateLimiter", RateLimiter)
+
+def host_of(url: str) -> str:
+  return urllib.parse.urlsplit(url).netloc
+
+class Limited():
+  # with Limited(limiter, url): ... runs the request once the host allows it
+  # and reports its latency, an exception counts as a failed request
+
+  def __init__(self, limiter, url: str) -> None:
+    self.limiter = limiter
+    self.host = host_of(url)
+
+  def __enter__(self):
+    while True:
+      wait = self.limiter.acquire(self.host)
+      if wait == 0: break
+      time.sleep(wait)
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.limiter.release(self.host, time.perf_counter() - self.start, exc_type is None)
+    return False
+
+  async def __aenter__(self):
+    while True:
+      wait = self.limiter.acquire(self.host)
+      if wait == 0: break
+      await asyncio.sleep(wait)
+    self.start = time.perf_counter()
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    self.limiter.release(self.host, time.perf_counter() - self.start, exc_type is None)
+    return False
@@ -0,0 +1,229 @@
+import mmap
+import os
+import numpy
+import struct
+
+# Binary stock data snapshot.
+#
+# A snapshot holds the same records as the stock data text file, packed into
+# numpy arrays so loading it is a handful of frombuffer calls:
+#
+#   header        magic, version and the size of every section
+#   string table  u32 lengths + utf-8 bytes of every metric label, scalar key,
+#                 info key and info value (each stored once)
+#   stocks        per stock: first/count of its info and series entries
+#   scalars       float64 per stock and scalar key, NaN when not set
+#   info          (key, value) string ids
+#   series        (label string id, first value, value count)
+#   periods       int64 period of every value
+#   values        float64 values
+#   index         footer: stock ids (int64, sorted) and their rows in the
+#                 stocks table (u32), followed by the footer trailer
+#
+# Every section starts on an 8 byte boundary. A record is the plain data of
+# one stock: (info, scalars, series) with info a str -> str dict, scalars a
+# str -> float dict and series a label -> (periods, values) dict.
+
+extension = ".snap"
+
+magic = b"STOCKSNP"
+version = 2
+
+header = struct.Struct("<8sIIIIIIII")
+trailer = struct.Struct("<QQ8s")
+index_magic = b"STOCKIDX"
+
+stock_dtype  = numpy.dtype([('info_start', '<u4'), ('info_count', '<u4'), ('series_start', '<u4'), ('series_count', '<u4')])
+info_dtype   = numpy.dtype([('key', '<u4'), ('value', '<u4')])
+series_dtype = numpy.dtype([('label', '<u4'), ('start', '<u4'), ('count', '<u4')])
+
+def is_snapshot(filename: str) -> bool:
+  return filename.endswith(extension)
+
+def padding(size: int) -> bytes:
+  return b"\0" * (-size % 8)
+
+class StringTable():
+
+  def __init__(self) -> None:
+    self.ids = {}
+    self.strings = []
+
+  def add(self, string: str) -> int:
+    if string not in self.ids:
+      self.ids[string] = len(self.strings)
+      self.strings.append(string)
+    return self.ids[string]
+
+  def as_bytes(self):
+    encoded = [string.encode("utf-8") for string in self.strings]
+    lengths = numpy.array([len(data) for data in encoded], dtype='<u4')
+    return (lengths.tobytes() + padding(lengths.nbytes), b"".join(encoded))
+
+def encode(records: [], scalar_keys: ()) -> bytes:
+  strings = StringTable()
+  for key in scalar_keys:
+    strings.add(key)
+
+  stocks = numpy.zeros(len(records), dtype=stock_dtype)
+  scalars = numpy.full((len(records), len(scalar_keys)), numpy.nan)
+  info = []
+  series = []
+  periods = []
+  values = []
+  nvalues = 0
+
+  ids = numpy.zeros(len(records), dtype='<i8')
+
+  for i, (record_info, record_scalars, record_series) in enumerate(records):
+    ids[i] = int(record_info['id'])
+    stocks[i] = (len(info), len(record_info), len(series), len(record_series))
+    for key, value in record_info.items():
+      info.append((strings.add(key), strings.add(str(value))))
+    for j, key in enumerate(scalar_keys):
+      if key in record_scalars:
+        scalars[i, j] = record_scalars[key]
+    for label, (label_periods, label_values) in record_series.items():
+      series.append((strings.add(label), nvalues, len(label_values)))
+      periods.append(numpy.asarray(label_periods, dtype='<i8'))
+      values.append(numpy.asarray(label_values, dtype='<f8'))
+      nvalues += len(label_values)
+
+  (lengths, string_bytes) = strings.as_bytes()
+  sections = [
+    lengths,
+    string_bytes + padding(len(string_bytes)),
+    stocks.tobytes() + padding(stocks.nbytes),
+    scalars.astype('<f8').tobytes(),
+    numpy.array(info, dtype=info_dtype).tobytes() + padding(len(info) * info_dtype.itemsize),
+    numpy.array(series, dtype=series_dtype).tobytes() + padding(len(series) * series_dtype.itemsize),
+    numpy.concatenate(periods + [numpy.empty(0, dtype='<i8')]).tobytes(),
+    numpy.concatenate(values + [numpy.empty(0, dtype='<f8')]).tobytes(),
+  ]
+  head = header.pack(magic, version, len(strings.strings), len(string_bytes), len(scalar_keys),
+                     len(records), len(info), len(series), nvalues)
+  body = head + padding(header.size) + b"".join(sections)
+
+  order = numpy.argsort(ids, kind='stable')
+  rows = order.astype('<u4')
+  index = ids[order].tobytes() + rows.tobytes() + padding(rows.nbytes)
+  return body + index + trailer.pack(len(body), len(records), index_magic)
+
+class Snapshot():
+  # Decoded view of a snapshot buffer (bytes or a memory map). The numpy
+  # arrays are views into the buffer; records are decoded on request.
+
+  def __init__(self, buffer) -> None:
+    self.buffer = buffer
+
+    (file_magic, file_version, nstrings, string_bytes, nscalar_keys,
+     nstocks, ninfo, nseries, nvalues) = header.unpack_from(buffer, 0)
+    if file_magic != magic:
+      raise ValueError("not a stock data snapshot")
+    if file_version != version:
+      raise ValueError("unsupported stock data snapshot version %d" % file_version)
+
+    offset = header.size + len(padding(header.size))
+
+    def section(dtype, count, shape = None):
+      nonlocal offset
+      dtype = numpy.dtype(dtype)
+      array = numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+      offset += count * dtype.itemsize + len(padding(count * dtype.itemsize))
+      return array if shape is None else array.reshape(shape)
+
+    lengths = section('<u4', nstrings)
+    data = bytes(section('u1', string_bytes))
+    ends = numpy.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    self.strings = [data[start:end].decode("utf-8") for (start, end) in zip(starts, ends)]
+    self.scalar_keys = self.strings[:nscalar_keys]
+
+    self.stocks  = section(stock_dtype, nstocks)
+    self.scalars = section('<f8', nstocks * nscalar_keys, (nstocks, nscalar_keys))
+    self.info    = section(info_dtype, ninfo)
+    self.series  = section(series_dtype, nseries)
+    self.periods = section('<i8', nvalues)
+    self.values  = section('<f8', nvalues)
+
+    (index_offset, index_count, file_index_magic) = trailer.unpack_from(buffer, len(buffer) - trailer.size)
+    if file_index_magic != index_magic or index_count != nstocks:
+      raise ValueError("stock data snapshot index is damaged")
+    offset = index_offset
+    self.ids  = section('<i8', index_count)
+    self.rows = section('<u4', index_count)
+
+  def find(self, stock_id: int) -> int:
+    # row of the stock in the stocks table, -1 if it is not in the snapshot
+    i = numpy.searchsorted(self.ids, stock_id)
+    if i < len(self.ids) and self.ids[i] == stock_id:
+      return int(self.rows[i])
+    return -1
+
+  def close(self):
+    # drop the views into the buffer first, a memory map with exported
+    # buffers cannot be closed
+    for name in ('stocks', 'scalars', 'info', 'series', 'periods', 'values', 'ids', 'rows'):
+      setattr(self, name, None)
+    if isinstance(self.buffer, mmap.mmap):
+      self.buffer.close()
+
+  def __len__(self) -> int:
+    return len(self.stocks)
+
+  def record(self, i: int):
+    (info_start, info_count, series_start, series_count) = self.stocks[i].tolist()
+    return self.decode(self.info[info_start:info_start + info_count].tolist(),
+                       self.scalars[i].tolist(),
+                       self.series[series_start:series_start + series_count].tolist())
+
+  def decode(self, info_rows, scalar_values, series_rows):
+    strings = self.strings
+
+    info = {}
+    for (key, value) in info_rows:
+      info[strings[key]] = strings[value]
+
+    scalars = {}
+    for key, value in zip(self.scalar_keys, scalar_values):
+      if value == value:
+        scalars[key] = value
+
+    series = {}
+    for (label, start, count) in series_rows:
+      series[strings[label]] = (self.periods[start:start + count], self.values[start:start + count])
+
+    return (info, scalars, series)
+
+  def records(self):
+    # all records, converting the tables to lists once instead of per stock
+    (info, series, scalars) = (self.info.tolist(), self.series.tolist(), self.scalars.tolist())
+    for i, (info_start, info_count, series_start, series_count) in enumerate(self.stocks.tolist()):
+      yield self.decode(info[info_start:info_start + info_count], scalars[i],
+                        series[series_start:series_start + series_count])
+
+def write(filename: str, records: [], scalar_keys: ()):
+  write_bytes(filename, encode(records, scalar_keys))
+
+def write_bytes(filename: str, data: bytes):
+  # write next to the file and swap it in, a crash never leaves half a file
+  f = open(filename + ".tmp", "wb")
+  f.write(data)
+  f.flush()
+  os.fsync(f.fileno())
+  f.close()
+  os.replace(filename + ".tmp", filename)
+
+def read(filename: str) -> Snapshot:
+  f = open(filename, "rb")
+  buffer = bytearray(f.read())
+  f.close()
+  return Snapshot(buffer)
+
+def open_mapped(filename: str) -> Snapshot:
+  # Copy on write map: pages are read from the file only when touched and
+  # changes to decoded arrays never reach the file.
+  f = open(filename, "rb")
+  buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+  f.close()
+  return Snapshot(buffer)
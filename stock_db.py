@@ -0,0 +1,190 @@
+import sys
+import sqlite3
+import numpy
+
+# SQLite stock store.
+#
+#   stock_info     (stock_id, key, value)                  id, name, +skip, ...
+#   stock_scalars  (stock_id, key, value)                  price, number_of_shares, ...
+#   stock_data     (stock_id, metric, year, quarter, value)
+#
+# metric is the series label ("A dividend", "Q cash_flow_from_operations"),
+# annual rows have quarter 0. The database runs in WAL mode and every update
+# is one short IMMEDIATE transaction that only touches the changed rows, so
+# several processes can update prices and fundamentals of the same database
+# at the same time.
+#
+# Like snapshot.py this module works on records, the plain data of a stock:
+# (info, scalars, series) with series a label -> (periods, values) dict and a
+# quarter period being year*10+quarter.
+#
+#   python stock_db.py stock_data.db "select ..."      runs an ad-hoc query
+
+extensions = (".db", ".sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS stock_info (
+  stock_id INTEGER NOT NULL,
+  key      TEXT NOT NULL,
+  value    TEXT NOT NULL,
+  PRIMARY KEY (stock_id, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stock_scalars (
+  stock_id INTEGER NOT NULL,
+  key      TEXT NOT NULL,
+  value    REAL NOT NULL,
+  PRIMARY KEY (stock_id, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stock_data (
+  stock_id INTEGER NOT NULL,
+  metric   TEXT NOT NULL,
+  year     INTEGER NOT NULL,
+  quarter  INTEGER NOT NULL,
+  value    REAL NOT NULL,
+  PRIMARY KEY (stock_id, metric, year, quarter)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS stock_data_metric ON stock_data (metric, year, quarter, stock_id);
+"""
+
+def is_database(filename: str) -> bool:
+  return filename.endswith(extensions)
+
+def period_columns(label: str, period: int):
+  # (year, quarter) columns of a series period
+  if label.startswith("Q "):
+    return (period // 10, period % 10)
+  return (period, 0)
+
+class StockDatabase():
+
+  def __init__(self, filename: str, timeout: float = 30) -> None:
+    self.filename = filename
+    self.connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.executescript(schema)
+
+  def close(self):
+    self.connection.close()
+
+  def transaction(self):
+    return Transaction(self.connection)
+
+  def execute(self, sql: str, parameters = ()):
+    return self.connection.execute(sql, parameters)
+
+  # reading
+
+  def get_ids(self) -> []:
+    return [row[0] for row in self.execute("SELECT stock_id FROM stock_info WHERE key = 'id' ORDER BY stock_id")]
+
+  def has_stock(self, stock_id: int) -> bool:
+    return self.execute("SELECT 1 FROM stock_info WHERE stock_id = ? AND key = 'id'", (stock_id,)).fetchone() is not None
+
+  def read_record(self, stock_id: int):
+    info = dict(self.execute("SELECT key, value FROM stock_info WHERE stock_id = ?", (stock_id,)))
+    if not info:
+      return None
+    scalars = dict(self.execute("SELECT key, value FROM stock_scalars WHERE stock_id = ?", (stock_id,)))
+
+    data = {}
+    rows = self.execute("SELECT metric, year, quarter, value FROM stock_data WHERE stock_id = ? ORDER BY metric, year, quarter", (stock_id,))
+    for (metric, year, quarter, value) in rows:
+      period = year * 10 + quarter if metric.startswith("Q ") else year
+      data.setdefault(metric, ([], []))
+      data[metric][0].append(period)
+      data[metric][1].append(value)
+
+    series = {}
+    for metric, (periods, values) in data.items():
+      series[metric] = (numpy.array(periods, dtype=numpy.int64), numpy.array(values, dtype=numpy.float64))
+
+    return (info, scalars, series)
+
+  # writing
+
+  def write_record(self, stock_id: int, record):
+    # replaces everything stored for the stock
+    self.write_records([(stock_id, record)])
+
+  def write_records(self, records: [], delete_others: bool = False):
+    # (stock id, record) pairs in one transaction, delete_others makes the
+    # database hold exactly these stocks
+    with self.transaction() as cursor:
+      if delete_others:
+        for table in ("stock_info", "stock_scalars", "stock_data"):
+          cursor.execute("DELETE FROM %s" % table)
+
+      for (stock_id, (info, scalars, series)) in records:
+        if not delete_others:
+          for table in ("stock_info", "stock_scalars", "stock_data"):
+            cursor.execute("DELETE FROM %s WHERE stock_id = ?" % table, (stock_id,))
+        cursor.executemany("INSERT INTO stock_info VALUES (?, ?, ?)",
+                           [(stock_id, key, str(value)) for key, value in info.items()])
+        cursor.executemany("INSERT INTO stock_scalars VALUES (?, ?, ?)",
+                           [(stock_id, key, value) for key, value in scalars.items()])
+        cursor.executemany("INSERT INTO stock_data VALUES (?, ?, ?, ?, ?)",
+                           [(stock_id, label) + period_columns(label, period) + (value,)
+                            for label, (periods, values) in series.items()
+                            for period, value in zip(periods.tolist(), values.tolist())])
+
+  def apply(self, stock_id: int, changes: []):
+    # changes are ('info', key, value), ('scalar', key, value or None to
+    # delete) and ('data', label, period, value), written in one transaction
+    with self.transaction() as cursor:
+      for change in changes:
+        if change[0] == 'info':
+          cursor.execute("INSERT OR REPLACE INTO stock_info VALUES (?, ?, ?)", (stock_id, change[1], str(change[2])))
+        elif change[0] == 'scalar' and change[2] is None:
+          cursor.execute("DELETE FROM stock_scalars WHERE stock_id = ? AND key = ?", (stock_id, change[1]))
+        elif change[0] == 'scalar':
+          cursor.execute("INSERT OR REPLACE INTO stock_scalars VALUES (?, ?, ?)", (stock_id, change[1], change[2]))
+        elif change[0] == 'data':
+          (label, period, value) = change[1:]
+          cursor.execute("INSERT OR REPLACE INTO stock_data VALUES (?, ?, ?, ?, ?)",
+                         (stock_id, label) + period_columns(label, period) + (value,))
+
+  def delete(self, stock_id: int):
+    with self.transaction() as cursor:
+      for table in ("stock_info", "stock_scalars", "stock_data"):
+        cursor.execute("DELETE FROM %s WHERE stock_id = ?" % table, (stock_id,))
+
+  # queries
+
+  def stocks_with_quarters(self, metric: str, year: int, nquarters: int = 4) -> []:
+    # e.g. stocks_with_quarters("cash_flow_from_operations", 2019)
+    rows = self.execute("SELECT stock_id FROM stock_data WHERE metric = ? AND year = ? AND quarter > 0 "
+                        "GROUP BY stock_id HAVING count(*) >= ? ORDER BY stock_id",
+                        ("Q " + metric, year, nquarters))
+    return [row[0] for row in rows]
+
+class Transaction():
+  # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers wait
+  # for each other (up to the connection timeout) instead of failing mid way.
+
+  def __init__(self, connection) -> None:
+    self.connection = connection
+
+  def __enter__(self):
+    self.connection.execute("BEGIN IMMEDIATE")
+    return self.connection.cursor()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.connection.execute("COMMIT")
+    else:
+      self.connection.execute("ROLLBACK")
+    return False
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print("usage: python stock_db.py <database> <sql>")
+    sys.exit(1)
+
+  database = StockDatabase(sys.argv[1])
+  for row in database.execute(sys.argv[2]):
+    print("\t".join(str(column) for column in row))
+  database.close()